@@ -49,9 +49,9 @@ class UserAbort(BaseException):
 
 from .utils import stderr
 from .db import Database
-from .table import Table, Column, SubColumn, LazyRow
+from .table import Table, ColumnarTable, Column, SubColumn, LazyRow
 from .interpreter import AIPL, defop, Command, alias
-from .caching import expensive, dbcache
+from .caching import expensive, dbcache, dbcache_batch, memoize
 from .parser import parse
 from .repl import repl
 from .main import main
@@ -1,51 +1,1175 @@
 from functools import wraps
+import hashlib
+import inspect
+import asyncio
+import json
+import base64
+import glob
+import atexit
+import pickle
+import os
+import zlib
+import threading
+import socket
+import time
+import weakref
+import copy
+import abc
+import sqlite3
 
-from aipl import AIPL, stderr
+from aipl import AIPL, Database, AIPLException, Error, stderr
+from aipl.db import sqlite_type
+from aipl.utils import AttrDict, sizeof
 
 
-def dbcache(func):
-    'Decorator to persistently cache result from func(aipl, *args, *kwargs).'
-    @wraps(func)
-    def cachingfunc(aipl:AIPL, *args, **kwargs):
-        if not aipl.cache_db:
-            return func(aipl, *args, **kwargs)
+MISSING = object()
+
+
+def _sha256(s:str) -> str:
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+
+def _jsonable(obj):
+    if isinstance(obj, bytes):
+        return dict(bytes=obj.hex())
+    if hasattr(obj, '_asdict'):  # Table, LazyRow
+        return obj._asdict()
+    return repr(obj)
+
+
+def cache_key(*args, **kwargs) -> str:
+    'Return key for cached result of a call with *args* and *kwargs*: a hash of their canonical JSON, so that the order of kwargs does not matter.'
+    return _sha256(json.dumps([args, kwargs], sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=_jsonable))
+
+
+def legacy_cache_key(*args, **kwargs) -> str:
+    'Return key that dbcache used before cache_key, as converted by _migrate.'
+    return _sha256(f'{args} {kwargs}')
+
+
+# columns added to each entry in cache tables: when it was stored and last read from the database, and how many times; what it cost to compute;
+# which values are compressed, and which are in blob_dir; how to check that it is still current (see dbcache revalidate=)
+CACHE_META = dict(_created='REAL', _accessed='REAL', _hits='INTEGER', _cost_usd='REAL', _cost_ms='INTEGER', _codec='TEXT', _blobs='TEXT', _validators='TEXT')
+
+_ttls = {}  # cache table -> ttl given to @dbcache
+_revalidators = {}  # cache table -> revalidate given to @dbcache
+
+
+def parse_duration(v) -> float:
+    'Return number of seconds in *v*: a number, optionally followed by s, m, h, or d (e.g. "12h").'
+    if isinstance(v, str) and v and v[-1] in 'smhd':
+        return float(v[:-1]) * dict(s=1, m=60, h=3600, d=86400)[v[-1]]
+    return float(v or 0)
+
+
+def cache_ttl(aipl:AIPL, tbl:str) -> float:
+    '''Return max age in seconds of entries in cache table *tbl*, or 0 for no limit.
+    This is option cache_ttl_<name> (e.g. `!option cache_ttl_fetch_url=7d` for cached__fetch_url), else ttl= given to @expensive, else option cache_ttl.'''
+    name = tbl[len('cached_'):].lstrip('_')
+    v = aipl.options.get('cache_ttl_'+name)
+    if v is None:
+        v = _ttls.get(tbl)
+    if v is None:
+        v = aipl.options.cache_ttl
+    return parse_duration(v)
+
+
+_migrated = weakref.WeakKeyDictionary()  # Database -> set of cache tables with index
+
+def _migrate(db:Database, tbl:str):
+    '''Add unique index on "key", and CACHE_META columns, to cache table *tbl*, once.
+    Before they had this index, cache tables had the plain text of the arguments as key; these are replaced with their hash, so they can still be found with legacy_cache_key.'''
+    if tbl in _migrated.setdefault(db, set()) or not db.get_table_info(tbl):
+        return
+
+    with db.lock:
+        if not db.has_index(tbl, f'{tbl}_key'):
+            stderr(f'migrating {tbl} to hashed keys...')
+            db.con.create_function('aipl_sha256', 1, _sha256, deterministic=True)
+            db.con.execute(f'UPDATE "{tbl}" SET "key"=aipl_sha256("key")')
+            db.con.execute(f'DELETE FROM "{tbl}" WHERE rowid NOT IN (SELECT MAX(rowid) FROM "{tbl}" GROUP BY "key")')  # keep latest
+            db.create_index(tbl, 'key', unique=True)
+
+        if any(k not in db.get_table_info(tbl) for k in CACHE_META):
+            db.flush()
+            db._retry(_add_meta_columns, db, tbl)
+            db.tables.pop(tbl, None)  # get_table_info again
+
+    _migrated[db].add(tbl)
+
+
+def _add_meta_columns(db:Database, tbl:str):
+    'Add CACHE_META columns missing from *tbl*; another process may be adding them at the same time.'
+    try:
+        db.con.execute('BEGIN IMMEDIATE')
+        tinfo = {r['name'] for r in db.con.execute(f'PRAGMA table_info("{tbl}")').fetchall()}  # as of now, not as cached in db.tables
+        missing = [k for k in CACHE_META if k not in tinfo]
+        for k in missing:
+            try:
+                db.con.execute(f'ALTER TABLE "{tbl}" ADD COLUMN "{k}" {CACHE_META[k]}')
+            except sqlite3.OperationalError as e:
+                if 'duplicate column' not in str(e):
+                    raise
+        if missing:
+            now = time.time()  # for lack of anything better
+            db.con.execute(f'UPDATE "{tbl}" SET "_created"=ifnull("_created", ?), "_accessed"=ifnull("_accessed", ?), "_hits"=ifnull("_hits", 0)', (now, now))
+        db.con.commit()
+    except BaseException:
+        db.con.rollback()
+        raise
+
+
+def _create_cache_table(db:Database, tbl:str, row:dict):
+    'Create cache table *tbl* for rows like *row*, with all CACHE_META columns, so no other process has to add them later.'
+    cols = {k:sqlite_type(v) for k, v in dict(row, key='').items() if k not in CACHE_META}
+    cols.update(CACHE_META)
+    fieldstr = ', '.join(f'"{k}" {t}' for k, t in cols.items())
+    db.con.execute(f'CREATE TABLE IF NOT EXISTS "{tbl}" ({fieldstr})')
+
+
+def blob_dir(aipl:AIPL) -> str:
+    'Return directory of large cached values (see _store_blobs): option cache_blob_dir, else next to cache_db.'
+    return aipl.options.cache_blob_dir or aipl.cache_db.dbfn + '.blobs'
+
+
+def _blob_path(aipl:AIPL, h:str) -> str:
+    return os.path.join(blob_dir(aipl), h[:2], h)
+
+
+def _put_blob(aipl:AIPL, data:bytes) -> str:
+    'Store *data* in blob_dir under the hash of its contents, unless already there.  Return the hash.'
+    h = hashlib.sha256(data).hexdigest()
+    path = _blob_path(aipl, h)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmppath = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmppath, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmppath, path)  # never a partial blob, even with other processes
+    return h
+
+
+def _get_blob(aipl:AIPL, h:str) -> bytes:
+    with open(_blob_path(aipl, h), 'rb') as fp:
+        return fp.read()
+
+
+def _store_blobs(aipl:AIPL, row:dict) -> dict:
+    '''Return copy of *row* with its str and bytes values larger than option cache_blob_bytes stored in blob_dir instead, replaced by their hash.
+    "_blobs" lists those columns, as JSON {colname: "str" or "bytes"}.  Identical values are stored once.'''
+    limit = int(aipl.options.get('cache_blob_bytes', 64*1024) or 0)
+    ret = dict(row, _blobs=None)
+    kinds = {}
+    for k, v in row.items():
+        if limit and isinstance(v, (str, bytes)) and len(v) > limit:
+            ret[k] = _put_blob(aipl, v.encode('utf-8') if isinstance(v, str) else v)
+            kinds[k] = type(v).__name__
+    if kinds:
+        ret['_blobs'] = json.dumps(kinds)
+    return ret
+
+
+def _load_blobs(aipl:AIPL, row:dict) -> dict:
+    'Return *row* from cache table with its values from blob_dir (see _store_blobs).'
+    if not row.get('_blobs'):
+        return row
+    ret = AttrDict(row)
+    for k, kind in json.loads(row['_blobs']).items():
+        data = _get_blob(aipl, row[k])
+        ret[k] = data.decode('utf-8') if kind == 'str' else data
+    return ret
+
+
+def _compress(codec:str, data:bytes) -> bytes:
+    if codec == 'zlib':
+        return zlib.compress(data)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    raise AIPLException(f'unknown cache codec {codec!r}')
+
+
+def _decompress(codec:str, data:bytes) -> bytes:
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise AIPLException(f'unknown cache codec {codec!r}')
+
+
+_codec_fallbacks = {}  # codec -> codec to use instead, once found to be unusable
+
+def write_codec(aipl:AIPL) -> str:
+    '''Return codec to compress new cache entries with: option cache_codec (zlib, zstd, or none), or zlib if that needs a package which is not installed.
+    Checked when aipl starts, so the cache write after a (maybe costly) call never fails for lack of it.'''
+    codec = aipl.options.get('cache_codec', 'zlib') or 'none'
+    if codec not in _codec_fallbacks:
+        _codec_fallbacks[codec] = codec
+        if codec == 'zstd':
+            try:
+                import zstandard
+            except ModuleNotFoundError:
+                stderr('zstandard not installed; compressing cache entries with zlib instead')
+                _codec_fallbacks[codec] = 'zlib'
+        elif codec not in ('zlib', 'none'):
+            stderr(f'unknown cache codec {codec!r}; using zlib instead')
+            _codec_fallbacks[codec] = 'zlib'
+    return _codec_fallbacks[codec]
+
+
+def _compress_values(aipl:AIPL, row:dict) -> dict:
+    '''Return copy of *row* with its str and bytes values larger than option cache_compress_bytes compressed with option cache_codec (zlib, zstd, or none).
+    "_codec" lists those columns, as JSON {colname: [codec, "str" or "bytes"]}, so rows stored with any codec (or none) can be read.'''
+    codec = write_codec(aipl)
+    limit = int(aipl.options.get('cache_compress_bytes', 1024) or 0)
+    ret = dict(row, _codec=None)
+    if codec == 'none':
+        return ret
+
+    codecs = {}
+    for k, v in row.items():
+        if isinstance(v, (str, bytes)) and len(v) > limit:
+            data = v.encode('utf-8') if isinstance(v, str) else v
+            compressed = _compress(codec, data)
+            if len(compressed) < len(data):
+                ret[k] = compressed
+                codecs[k] = [codec, type(v).__name__]
+    if codecs:
+        ret['_codec'] = json.dumps(codecs)
+    return ret
+
+
+def _decompress_values(row:dict) -> dict:
+    'Return *row* from cache table with its values decompressed (see _compress_values).'
+    if not row.get('_codec'):
+        return row
+    ret = AttrDict(row)
+    for k, (codec, kind) in json.loads(row['_codec']).items():
+        data = _decompress(codec, row[k])
+        ret[k] = data.decode('utf-8') if kind == 'str' else data
+    return ret
+
+
+def _cache_row(aipl:AIPL, tbl:str, key:str, legacy_key:str='') -> tuple:
+    'Return (row, bytes read from cache backend) for *key* (or *legacy_key*, from before keys were canonical) from aipl.prefetched or aipl.cache_mem, else cache table *tbl*; row is MISSING if not there.'
+    memkey = (aipl.cache_db.dbfn, tbl, key)
+    row = aipl.prefetched.get(memkey, MISSING)
+    if row is MISSING:
+        row = aipl.cache_mem.get(memkey, MISSING)
+    nbytes = 0
+    if row is MISSING:
+        backend = cache_backend(aipl)
+        row = backend.get(tbl, key)
+        if row is None and legacy_key:
+            row = backend.get(tbl, legacy_key)
+            if row is not None:
+                backend.put(tbl, key, row)
+        if row is None:
+            return MISSING, 0
+        try:
+            row = _decompress_values(_load_blobs(aipl, row))
+        except FileNotFoundError:
+            return MISSING, 0  # blob_dir lost or moved; compute again
+        nbytes = sizeof(row)
+        aipl.cache_mem.put(memkey, row)
+
+    ttl = cache_ttl(aipl, tbl)
+    if ttl and time.time() - (row.get('_created') or 0) > ttl:
+        return MISSING, nbytes  # expired; will be replaced
+
+    return row, nbytes
+
 
-        key = f'{args} {kwargs}'
-        tbl = 'cached_'+func.__name__
-        ret = aipl.cache_db.select(tbl, key=key)
+def _cache_get(aipl:AIPL, tbl:str, key:str, legacy_key:str='', count:bool=True):
+    'Return cached result for *key* from _cache_row, or MISSING.  If *count*, add to aipl.cache_stats.'
+    start_t = time.perf_counter()
+    row, nbytes = _cache_row(aipl, tbl, key, legacy_key)
+    if count:
+        if row is MISSING:
+            counts = dict(misses=1)
+        else:
+            counts = dict(hits=1, saved_usd=row.get('_cost_usd') or 0, saved_secs=(row.get('_cost_ms') or 0)/1000)
+        aipl.cache_stats.add(tbl, bytes_read=nbytes, lookup_secs=time.perf_counter()-start_t, **counts)
+
+    if row is MISSING:
+        return MISSING
+
+    if 'output' in row:
+        return _copied(row['output'])
+
+    stderr('[using cached value]')
+    return AttrDict((k, _copied(v)) for k, v in row.items() if k != 'key' and k not in CACHE_META)
+
+
+def _copied(v):
+    'Return *v*, or a deep copy of it if it is mutable, so changing a result from aipl.cache_mem does not change what is cached.'
+    return v if isinstance(v, (str, bytes, int, float, bool, type(None))) else copy.deepcopy(v)
+
+
+class CacheBackend(abc.ABC):
+    '''Where @dbcache keeps its entries: a row (dict) for each key, in a table for each cached function.
+    get and get_many return rows as given to put (maybe with "key" too), or None if not there.'''
+    name = ''
+
+    def get(self, tbl:str, key:str) -> dict|None:
+        return self.get_many(tbl, [key]).get(key)
+
+    @abc.abstractmethod
+    def get_many(self, tbl:str, keys:list) -> dict:
+        'Return dict of key -> row, for those of *keys* in *tbl*.'
+
+    def put(self, tbl:str, key:str, row:dict):
+        self.put_many(tbl, {key: row})
+
+    @abc.abstractmethod
+    def put_many(self, tbl:str, rows:dict):
+        'Store rows from dict of key -> row in *tbl*, replacing any there.'
+
+    @abc.abstractmethod
+    def delete(self, tbl:str, keys:list):
+        'Remove *keys* from *tbl*, if there.'
+
+    @abc.abstractmethod
+    def stats(self) -> dict:
+        'Return dict(entries=, bytes=, ...).'
+
+    @abc.abstractmethod
+    def items(self):
+        'Yield (tbl, key, row) for all entries.'
+
+    def blob_refs(self) -> set:
+        'Return hashes of all values stored in blob_dir (see _store_blobs) by entries.'
+        refs = set()
+        for tbl, key, row in self.items():
+            if row.get('_blobs'):
+                refs.update(row[k] for k in json.loads(row['_blobs']))
+        return refs
+
+    def gc(self, aipl:AIPL, max_bytes:int=0, evict:str='lru') -> AttrDict:
+        '''Delete expired entries (see cache_ttl).  Then, if entries total more than *max_bytes*, delete those least recently used (evict='lru') or least often used ('lfu') until they don't.
+        Return AttrDict(expired=, evicted=) counts.'''
+        now = time.time()
+        stats = AttrDict(expired=0, evicted=0)
+        expired = {}  # tbl -> keys
+        entries = []  # (order, tbl, key, nbytes)
+        for tbl, key, row in self.items():
+            ttl = cache_ttl(aipl, tbl)
+            if ttl and (row.get('_created') or 0) < now-ttl:
+                expired.setdefault(tbl, []).append(key)
+                stats.expired += 1
+            elif max_bytes:
+                order = (row.get('_hits') or 0, row.get('_accessed') or 0) if evict == 'lfu' else (row.get('_accessed') or 0,)
+                entries.append((order, tbl, key, sizeof(row)))
+
+        total = sum(e[3] for e in entries)
+        for order, tbl, key, nbytes in sorted(entries, key=lambda e: e[0]):
+            if total <= max_bytes:
+                break
+            expired.setdefault(tbl, []).append(key)
+            total -= nbytes
+            stats.evicted += 1
+
+        for tbl, keys in expired.items():
+            self.delete(tbl, keys)
+        return stats
+
+    def compact(self):
+        'Give back space freed by gc, if possible.'
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class SqliteBackend(CacheBackend):
+    'Entries in a table "cached_<funcname>" of sqlite Database *db*, with a column for each key of the rows, and the last time and number of times each was read (for --cache-gc).'
+    name = 'sqlite'
+
+    def __init__(self, db:Database):
+        self.db = db
+
+    def get(self, tbl:str, key:str) -> dict|None:
+        _migrate(self.db, tbl)
+        ret = self.db.select(tbl, key=key)
+        if not ret:
+            return None
+        self.db.execute(f'UPDATE "{tbl}" SET "_accessed"=?, "_hits"="_hits"+1 WHERE "key"=?', time.time(), key)
+        return ret[-1]
+
+    def get_many(self, tbl:str, keys:list) -> dict:
+        _migrate(self.db, tbl)
+        ret = {row['key']: row for row in self.db.select_in(tbl, 'key', keys)}
         if ret:
-            row = ret[-1]
-            if 'output' in row:
-                return row['output']
+            now = time.time()
+            self.db.executemany(f'UPDATE "{tbl}" SET "_accessed"=?, "_hits"="_hits"+1 WHERE "key"=?', [(now, k) for k in ret])
+        return ret
 
-            del row['key']
-            stderr('[using cached value]')
-            return row
+    def put_many(self, tbl:str, rows:dict):
+        db = self.db
+        with db.lock:  # so no other thread sees a new table before it has its index (and migrates it)
+            _migrate(db, tbl)
+            if rows and not db.get_table_info(tbl):
+                _create_cache_table(db, tbl, next(iter(rows.values())))
+            for key, row in rows.items():
+                db.upsert(tbl, **dict(row, key=key))
+            if tbl not in _migrated[db]:  # new table
+                db.create_index(tbl, 'key', unique=True)
+                _migrated[db].add(tbl)
 
-        result = func(aipl, *args, **kwargs)
+    def delete(self, tbl:str, keys:list):
+        if self.db.get_table_info(tbl):
+            self.db.executemany(f'DELETE FROM "{tbl}" WHERE "key"=?', [(k,) for k in keys])
 
-        if isinstance(result, dict):
-            aipl.cache_db.insert(tbl, key=key, **result)
+    def stats(self) -> dict:
+        self.db.flush()
+        tbls = cache_tables(self.db)
+        return dict(tables=len(tbls),
+                    entries=sum(self.db.query(f'SELECT COUNT(*) AS n FROM "{tbl}"')[0]['n'] for tbl in tbls),
+                    bytes=os.path.getsize(self.db.dbfn))
+
+    def items(self):
+        for tbl in cache_tables(self.db):
+            for row in self.db.query(f'SELECT * FROM "{tbl}"'):
+                yield tbl, row['key'], row
+
+    def blob_refs(self) -> set:
+        refs = set()
+        for tbl in cache_tables(self.db):
+            for r in self.db.query(f'SELECT * FROM "{tbl}" WHERE "_blobs" IS NOT NULL'):
+                refs.update(r[k] for k in json.loads(r['_blobs']))
+        return refs
+
+    def gc(self, aipl:AIPL, max_bytes:int=0, evict:str='lru') -> AttrDict:
+        'Like CacheBackend.gc, in SQL.'
+        db = self.db
+        stats = AttrDict(expired=0, evicted=0)
+        now = time.time()
+        tbls = cache_tables(db)
+        with db.lock:
+            db.flush()
+            for tbl in tbls:
+                _migrate(db, tbl)
+                ttl = cache_ttl(aipl, tbl)
+                if ttl:
+                    stats.expired += db.con.execute(f'DELETE FROM "{tbl}" WHERE "_created" < ?', (now-ttl,)).rowcount
+            db.con.commit()
+
+            if max_bytes:
+                entries = []  # (order, tbl, rowid, nbytes)
+                for tbl in tbls:
+                    nbytes = '+'.join(f'ifnull(length("{c}"),0)' for c in db.get_table_info(tbl))
+                    for r in db.query(f'SELECT rowid, "_accessed", "_hits", {nbytes} AS nbytes FROM "{tbl}"'):
+                        order = (r['_hits'], r['_accessed']) if evict == 'lfu' else (r['_accessed'],)
+                        entries.append((order, tbl, r['rowid'], r['nbytes']))
+
+                total = sum(e[3] for e in entries)
+                evicted = {}  # tbl -> list of (rowid,)
+                for _, tbl, rowid, nbytes in sorted(entries):
+                    if total <= max_bytes:
+                        break
+                    evicted.setdefault(tbl, []).append((rowid,))
+                    total -= nbytes
+                    stats.evicted += 1
+
+                for tbl, rowids in evicted.items():
+                    db.con.executemany(f'DELETE FROM "{tbl}" WHERE rowid=?', rowids)
+                db.con.commit()
+        return stats
+
+    def compact(self):
+        'Rebuild the indexes and VACUUM the database file.'
+        with self.db.lock:
+            self.db.flush()
+            self.db.con.execute('REINDEX')
+            self.db.con.execute('VACUUM')
+
+    def flush(self):
+        self.db.flush()
+
+
+def _kv_dumps(row:dict) -> bytes:
+    'Return *row* as JSON for a KVBackend, with its bytes values base64-encoded and listed in "_bytes" (like "_blobs").'
+    ret = dict(row)
+    kinds = [k for k, v in row.items() if isinstance(v, bytes)]
+    for k in kinds:
+        ret[k] = base64.b64encode(row[k]).decode('ascii')
+    if kinds:
+        ret['_bytes'] = kinds
+    return json.dumps(ret, ensure_ascii=False).encode('utf-8')
+
+
+def _kv_loads(data:bytes) -> dict|None:
+    'Return row from _kv_dumps *data*, or None if there is none (or it was pickled by an older version).'
+    if data is None:
+        return None
+    try:
+        row = AttrDict(json.loads(bytes(data).decode('utf-8')))
+    except ValueError:
+        return None
+    for k in row.pop('_bytes', None) or []:
+        row[k] = base64.b64decode(row[k])
+    return row
+
+
+class KVBackend(CacheBackend):
+    '''Entries as JSON (see _kv_dumps) in a key-value store: at *prefix*.lmdb if use_lmdb (memory-mapped, and shared by processes: readers never wait for each other or the writer), else at *prefix*.dbm.
+    dbm is whichever the Python build has (dbm.gnu, dbm.ndbm, or dbm.dumb, which is neither memory-mapped nor safe to share), so it is for a single process only.
+    Reads are not recorded, so --cache-gc evicts entries from it by when they were stored, not last used.'''
+    def __init__(self, prefix:str, use_lmdb:bool=True, map_size:int=2**36):
+        self.lock = threading.Lock()  # dbm is not thread-safe; lmdb serializes writers itself
+        self.env = None
+        self.dbm = None
+        if use_lmdb:
+            try:
+                import lmdb
+            except ModuleNotFoundError:
+                raise AIPLException('--cache-backend lmdb needs the lmdb package (pip install lmdb); --cache-backend dbm is for a single process only')
+            self.name = 'lmdb'
+            self.path = f'{prefix}.lmdb'
+            self.env = lmdb.open(self.path, map_size=map_size, max_readers=1024, readahead=False, metasync=False)
         else:
-            aipl.cache_db.insert(tbl, key=key, output=result)
+            import dbm
+            self.name = 'dbm'
+            self.path = f'{prefix}.dbm'
+            self.dbm = dbm.open(self.path, 'c')
+        _open_kvs.add(self)
+
+    def _k(self, tbl:str, key:str) -> bytes:
+        return f'{tbl}\0{key}'.encode('utf-8')
+
+    def get_many(self, tbl:str, keys:list) -> dict:
+        ret = {}
+        if self.env is not None:
+            with self.env.begin() as txn:
+                for key in keys:
+                    row = _kv_loads(txn.get(self._k(tbl, key)))
+                    if row is not None:
+                        ret[key] = row
+        else:
+            with self.lock:
+                for key in keys:
+                    row = _kv_loads(self.dbm.get(self._k(tbl, key)))
+                    if row is not None:
+                        ret[key] = row
+        return ret
+
+    def put_many(self, tbl:str, rows:dict):
+        items = [(self._k(tbl, key), _kv_dumps(row)) for key, row in rows.items()]
+        if self.env is not None:
+            with self.env.begin(write=True) as txn:
+                for k, v in items:
+                    txn.put(k, v)
+        else:
+            with self.lock:
+                for k, v in items:
+                    self.dbm[k] = v
+
+    def delete(self, tbl:str, keys:list):
+        if self.env is not None:
+            with self.env.begin(write=True) as txn:
+                for key in keys:
+                    txn.delete(self._k(tbl, key))
+        else:
+            with self.lock:
+                for key in keys:
+                    self.dbm.pop(self._k(tbl, key), None)
+
+    def items(self):
+        if self.env is not None:
+            with self.env.begin() as txn:
+                for k, v in txn.cursor():
+                    tbl, key = bytes(k).decode('utf-8').split('\0', 1)
+                    row = _kv_loads(v)
+                    if row is not None:
+                        yield tbl, key, row
+        else:
+            with self.lock:
+                ks = list(self.dbm.keys())
+            for k in ks:
+                with self.lock:
+                    v = self.dbm.get(k)
+                row = _kv_loads(v)
+                if row is not None:
+                    tbl, key = k.decode('utf-8').split('\0', 1)
+                    yield tbl, key, row
+
+    def stats(self) -> dict:
+        if self.env is not None:
+            entries = self.env.stat()['entries']
+        else:
+            with self.lock:
+                entries = len(self.dbm)
+        nbytes = 0
+        for fn in glob.glob(glob.escape(self.path) + '*'):  # lmdb makes a directory; dbm may add suffixes
+            if os.path.isdir(fn):
+                nbytes += sum(os.path.getsize(os.path.join(fn, x)) for x in os.listdir(fn))
+            else:
+                nbytes += os.path.getsize(fn)
+        return dict(entries=entries, bytes=nbytes)
+
+    def flush(self):
+        with self.lock:
+            if self.env is not None:
+                self.env.sync()
+            elif self.dbm is not None and hasattr(self.dbm, 'sync'):
+                self.dbm.sync()
+
+    def close(self):
+        with self.lock:
+            if self.env is not None:
+                self.env.close()
+            elif self.dbm is not None:
+                self.dbm.close()
+            self.env = self.dbm = None
+        _open_kvs.discard(self)
+
 
+_open_kvs = weakref.WeakSet()  # flushed at exit
+
+@atexit.register
+def _flush_kvs():
+    for kv in list(_open_kvs):
+        kv.flush()
+
+
+_backends = weakref.WeakKeyDictionary()  # cache_db -> CacheBackend
+_backends_lock = threading.Lock()
+
+def cache_backend(aipl:AIPL) -> CacheBackend:
+    '''Return where @dbcache keeps its entries, per option cache_backend:
+    "sqlite" (default; tables in cache_db), or "lmdb" or "dbm" (a KVBackend next to cache_db).'''
+    db = aipl.cache_db
+    with _backends_lock:
+        if db not in _backends:
+            kind = aipl.options.cache_backend or 'sqlite'
+            if kind == 'sqlite':
+                _backends[db] = SqliteBackend(db)
+            elif kind in ('lmdb', 'dbm'):
+                _backends[db] = KVBackend(db.dbfn, use_lmdb=(kind == 'lmdb'))
+            else:
+                raise AIPLException(f'unknown cache backend {kind!r}')
+        return _backends[db]
+
+
+def prefetch(aipl:AIPL, func, calls:list) -> tuple:
+    '''Load cached results of *func* (from @dbcache or @expensive) for all *calls* [(args, kwargs), ...] into aipl.prefetched, with cache_backend(aipl).get_many instead of a lookup per call.
+    They stay there (unlike in aipl.cache_mem, where they could be evicted before use) until the command is done.
+    Return (number of distinct calls cached, number to compute).'''
+    tbl = func.cache_table
+    keys = {cache_key(*args, **kwargs) for args, kwargs in calls}
+
+    start_t = time.perf_counter()
+    ttl = cache_ttl(aipl, tbl)
+    now = time.time()
+    found = 0
+    nbytes = 0
+    for key, row in cache_backend(aipl).get_many(tbl, list(keys)).items():
+        if ttl and now - (row.get('_created') or 0) > ttl:
+            continue
+        try:
+            row = _decompress_values(_load_blobs(aipl, row))
+        except FileNotFoundError:
+            continue
+        aipl.prefetched[(aipl.cache_db.dbfn, tbl, key)] = row
+        nbytes += sizeof(row)
+        found += 1
+
+    aipl.cache_stats.add(tbl, bytes_read=nbytes, lookup_secs=time.perf_counter()-start_t)  # hits are counted as each is used
+    return found, len(keys)-found
+
+
+def _cache_put(aipl:AIPL, tbl:str, key:str, result, cost_usd:float=0, cost_ms:int=0, validators:dict=None):
+    'Store *result* for *key*, which took *cost_usd* and *cost_ms* to compute (and *validators* from dbcache revalidate=), in aipl.cache_mem and in *tbl* of cache_backend(aipl).'
+    now = time.time()
+    row = dict(result) if isinstance(result, dict) else dict(output=result)
+    row.update(_created=now, _accessed=now, _hits=0, _cost_usd=cost_usd, _cost_ms=cost_ms, _validators=json.dumps(validators) if validators else None)
+    row = {k: _copied(v) for k, v in row.items()}  # the caller still has result
+    aipl.cache_mem.put((aipl.cache_db.dbfn, tbl, key), row)
+    dbrow = _store_blobs(aipl, _compress_values(aipl, row))
+    cache_backend(aipl).put(tbl, key, dbrow)
+    aipl.cache_stats.add(tbl, bytes_written=sizeof(dbrow))
+
+
+LEASES = '_cache_leases'  # table in cache_db of keys being computed, by which process
+
+
+def _owner(aipl:AIPL) -> str:
+    return f'{socket.gethostname()}:{os.getpid()}:{id(aipl)}'
+
+
+_leases_created = weakref.WeakSet()  # Databases with LEASES table
+
+def _create_leases(db:Database):
+    'Create LEASES table in *db*, once.'
+    if db not in _leases_created:
+        with db.lock:
+            db._retry(db.con.execute, f'CREATE TABLE IF NOT EXISTS "{LEASES}" ("tbl" TEXT, "key" TEXT, "owner" TEXT, "expires" REAL, PRIMARY KEY ("tbl", "key"))')
+            db._retry(db.con.commit)
+        _leases_created.add(db)
+
+
+def _lease_many(aipl:AIPL, tbl:str, keys:list) -> set:
+    '''Try to take the leases on computing the results for *keys*, which other processes using the same cache_db wait for (see _claim), in one transaction.
+    Return set of keys taken (or already ours); _release_many them after storing their results.'''
+    db = aipl.cache_db
+    owner = _owner(aipl)
+    lease_secs = parse_duration(aipl.options.cache_lease_secs or 600)  # in case this process dies without releasing it
+    if not keys:
+        return set()
+
+    def _take():
+        began = not db.con.in_transaction  # else already holding the write lock, for writes committed along with these
+        if began:
+            db.con.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            db.con.executemany(f'DELETE FROM "{LEASES}" WHERE "tbl"=? AND "key"=? AND "expires"<?', [(tbl, key, now) for key in keys])
+            db.con.executemany(f'INSERT OR IGNORE INTO "{LEASES}" VALUES (?, ?, ?, ?)', [(tbl, key, owner, now+lease_secs) for key in keys])
+            taken = set()
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                for r in db.con.execute(f'SELECT "key", "owner" FROM "{LEASES}" WHERE "tbl"=? AND "key" IN ({",".join(["?"]*len(chunk))})', (tbl, *chunk)):
+                    if r['owner'] == owner:
+                        taken.add(r['key'])
+            db.con.commit()
+            return taken
+        except BaseException:
+            if began:
+                db.con.rollback()
+            raise
+
+    _create_leases(db)
+    with db.lock:
+        taken = db._retry(_take)
+        db.uncommitted = 0  # committed with the leases
+        db.last_commit = time.monotonic()
+    return taken
+
+
+def _lease(aipl:AIPL, tbl:str, key:str) -> bool:
+    'Try to take the lease on computing the result for *key* (see _lease_many).  Return True if taken (or already ours); then _release it after storing the result.'
+    return key in _lease_many(aipl, tbl, [key])
+
+
+def _release_many(aipl:AIPL, tbl:str, keys:list):
+    'Give up leases on *keys*.  Committed along with their results (if any), so other processes see both at once.'
+    if keys:
+        aipl.cache_db.executemany(f'DELETE FROM "{LEASES}" WHERE "tbl"=? AND "key"=? AND "owner"=?', [(tbl, key, _owner(aipl)) for key in keys])
+
+
+def _release(aipl:AIPL, tbl:str, key:str):
+    'Give up lease on *key* (see _release_many).'
+    _release_many(aipl, tbl, [key])
+
+
+def _claim(aipl:AIPL, tbl:str, key:str, legacy_key:str=''):
+    '''Return result for *key* computed by another process that holds its lease, once it is stored;
+    or MISSING if this process holds the lease (then compute, _cache_put, and _release it).'''
+    if _lease(aipl, tbl, key):
+        return MISSING
+
+    stderr(f'[waiting for another process to compute {tbl}]')
+    delay = 0.05
+    while True:
+        time.sleep(delay)
+        delay = min(delay*2, 1)
+        aipl.cache_db.flush()  # so the next read sees what was committed since
+        ret = _cache_get(aipl, tbl, key, legacy_key, count=False)
+        if ret is not MISSING:
+            return ret
+        if _lease(aipl, tbl, key):  # released without a result, or expired
+            ret = _cache_get(aipl, tbl, key, legacy_key, count=False)  # stored just before release
+            if ret is not MISSING:
+                _release(aipl, tbl, key)
+            return ret
+
+
+def _cached_call(aipl:AIPL, tbl:str, key:str, func, *args, **kwargs):
+    '''Return cached result for *key*, or call func(aipl, *args, **kwargs) and cache its result.
+    If another process using the same cache_db is computing the same key, wait for its result instead.
+    If *tbl* has a revalidate function (see dbcache), func returns (result, validators), and a cached result is checked with revalidate before it is returned.'''
+    revalidate = _revalidators.get(tbl)
+    if not aipl.cache_db:
+        result = func(aipl, *args, **kwargs)
+        return result[0] if revalidate else result
+
+    legacy_key = legacy_cache_key(*args, **kwargs)
+    ret = _cache_get(aipl, tbl, key, legacy_key)
+    if ret is MISSING:
+        ret = _claim(aipl, tbl, key, legacy_key)
+    if ret is not MISSING:
+        if revalidate:
+            return _revalidate(aipl, tbl, key, ret, revalidate, *args, **kwargs)
+        return ret
+
+    try:
+        cost_usd, start_t = aipl.cost_usd, time.time()
+        result = func(aipl, *args, **kwargs)
+        validators = None
+        if revalidate:
+            result, validators = result
+        _cache_put(aipl, tbl, key, result, aipl.cost_usd-cost_usd, int((time.time()-start_t)*1000), validators)
+    finally:
+        _release(aipl, tbl, key)
+    return result
+
+
+def _revalidate(aipl:AIPL, tbl:str, key:str, ret, revalidate, *args, **kwargs):
+    '''Return cached result *ret* for *key* if revalidate(aipl, validators, *args, **kwargs) says it is still current, else the new result it gives.
+    revalidate returns (MISSING, validators) if current: the same validators if it is fresh (nothing is stored), or new ones (e.g. after an HTTP 304) to store with *ret*;
+    otherwise (new result, its validators).'''
+    row, _ = _cache_row(aipl, tbl, key)
+    validators = json.loads(row.get('_validators') or 'null') if row is not MISSING else None
+    if not validators:
+        return ret
+
+    cost_usd, start_t = aipl.cost_usd, time.time()
+    result, new_validators = revalidate(aipl, validators, *args, **kwargs)
+    if result is MISSING:
+        if new_validators is not validators:
+            _cache_put(aipl, tbl, key, ret, row.get('_cost_usd') or 0, row.get('_cost_ms') or 0, new_validators)
+        return ret
+
+    aipl.cache_stats.add(tbl, hits=-1, misses=1)  # counted as a hit by _cache_get
+    _cache_put(aipl, tbl, key, result, aipl.cost_usd-cost_usd, int((time.time()-start_t)*1000), new_validators)
+    return result
+
+
+async def _acached_call(aipl:AIPL, tbl:str, key:str, func, *args, **kwargs):
+    'Like _cached_call, for async func.'
+    if not aipl.cache_db:
+        return await func(aipl, *args, **kwargs)
+
+    legacy_key = legacy_cache_key(*args, **kwargs)
+    ret = _cache_get(aipl, tbl, key, legacy_key)
+    if ret is MISSING:
+        ret = await asyncio.to_thread(_claim, aipl, tbl, key, legacy_key)
+    if ret is not MISSING:
+        return ret
+
+    try:
+        cost_usd, start_t = aipl.cost_usd, time.time()
+        result = await func(aipl, *args, **kwargs)
+        _cache_put(aipl, tbl, key, result, aipl.cost_usd-cost_usd, int((time.time()-start_t)*1000))
+    finally:
+        await asyncio.to_thread(_release, aipl, tbl, key)
+    return result
+
+
+def dbcache(func=None, *, ttl=None, revalidate=None):
+    '''Decorator to persistently cache result from func(aipl, *args, *kwargs).  func may be `async def`.
+    Identical calls made while the first is in progress (e.g. from other rows of an io_bound operator) wait for its result instead (see aipl.single_flight).
+    Entries older than *ttl* (seconds, or e.g. "7d") are computed again; see cache_ttl.
+    With *revalidate*, func returns (result, validators) (a JSON-able dict, e.g. HTTP ETag; or None), stored with the result;
+    and a cached result with validators is only used once revalidate(aipl, validators, *args, **kwargs) says it is current (see _revalidate).'''
+    if func is None:
+        return lambda f: dbcache(f, ttl=ttl, revalidate=revalidate)
+
+    tbl = 'cached_'+func.__name__
+    if ttl is not None:
+        _ttls[tbl] = ttl
+    if revalidate is not None:
+        assert not inspect.iscoroutinefunction(func), 'revalidate= is not supported for async functions'
+        _revalidators[tbl] = revalidate
+
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def acachingfunc(aipl:AIPL, *args, **kwargs):
+            key = cache_key(*args, **kwargs)
+            future, first = aipl.single_flight.claim((tbl, key))
+            if not first:
+                return await asyncio.wrap_future(future)
+
+            try:
+                result = await _acached_call(aipl, tbl, key, func, *args, **kwargs)
+            except BaseException as e:
+                aipl.single_flight.finish((tbl, key), exception=e)
+                raise
+
+            aipl.single_flight.finish((tbl, key), result)
+            return result
+
+        acachingfunc.cache_table = tbl  # see prefetch
+        return acachingfunc
+
+    @wraps(func)
+    def cachingfunc(aipl:AIPL, *args, **kwargs):
+        key = cache_key(*args, **kwargs)
+        future, first = aipl.single_flight.claim((tbl, key))
+        if not first:
+            return future.result()
+
+        try:
+            result = _cached_call(aipl, tbl, key, func, *args, **kwargs)
+        except BaseException as e:
+            aipl.single_flight.finish((tbl, key), exception=e)
+            raise
+
+        aipl.single_flight.finish((tbl, key), result)
         return result
 
+    cachingfunc.cache_table = tbl
+    return cachingfunc
+
+
+def dbcache_batch(func, ttl=None):
+    '''Decorator to persistently cache results from func(aipl, values:list, *args, **kwargs) -> list, one entry per value.
+    Entries are shared with @dbcache on a function of the same name that takes a single value.  Only the values not already cached (or in progress) are passed to func, at most `batch_size` at a time.
+    func may return an Error for some values; those are not cached.'''
+    tbl = 'cached_'+func.__name__
+    if ttl is not None:
+        _ttls[tbl] = ttl
+
+    @wraps(func)
+    def cachingfunc(aipl:AIPL, values:list, *args, batch_size:int=0, **kwargs) -> list:
+        keys = [cache_key(v, *args, **kwargs) for v in values]
+        if aipl.cache_db:
+            results = [_cache_get(aipl, tbl, key, legacy_cache_key(v, *args, **kwargs)) for v, key in zip(values, keys)]
+        else:
+            results = [MISSING]*len(values)
+
+        misses = []  # indexes of values to pass to func
+        waiting = {}  # index -> Future of same call in progress
+        for i, key in enumerate(keys):
+            if results[i] is MISSING:
+                future, first = aipl.single_flight.claim((tbl, key))
+                if first:
+                    misses.append(i)
+                else:
+                    waiting[i] = future
+
+        batch_size = int(batch_size) or len(misses) or 1
+        leased = set()  # indexes of keys this process holds the lease on (see _lease)
+        try:
+            todo = misses
+            while todo:
+                if aipl.cache_db:
+                    taken = _lease_many(aipl, tbl, [keys[i] for i in todo])
+                    mine = [i for i in todo if keys[i] in taken]
+                    leased.update(mine)
+                else:
+                    mine = todo
+                for j in range(0, len(mine), batch_size):
+                    batch = mine[j:j+batch_size]
+                    cost_usd, start_t = aipl.cost_usd, time.time()
+                    computed = func(aipl, [values[i] for i in batch], *args, **kwargs)
+                    cost_usd = (aipl.cost_usd-cost_usd)/len(batch)  # split evenly
+                    cost_ms = int((time.time()-start_t)*1000/len(batch))
+                    for i, result in zip(batch, computed):
+                        if aipl.cache_db and not isinstance(result, Error):  # an Error is for this value only; not cached, like an exception
+                            _cache_put(aipl, tbl, keys[i], result, cost_usd, cost_ms)
+                        results[i] = result
+                        aipl.single_flight.finish((tbl, keys[i]), result)
+                    if aipl.cache_db:
+                        _release_many(aipl, tbl, [keys[i] for i in batch])
+                        leased.difference_update(batch)
+
+                todo = []  # those given up by other processes, now leased to this one
+                for i in misses:  # being computed by other processes
+                    if results[i] is MISSING:
+                        ret = _claim(aipl, tbl, keys[i], legacy_cache_key(values[i], *args, **kwargs))
+                        if ret is MISSING:
+                            todo.append(i)
+                        else:
+                            results[i] = ret
+                            aipl.single_flight.finish((tbl, keys[i]), ret)
+        except BaseException as e:
+            for i in misses:
+                if results[i] is MISSING:
+                    aipl.single_flight.finish((tbl, keys[i]), exception=e)
+            raise
+        finally:
+            if leased:
+                _release_many(aipl, tbl, [keys[i] for i in leased])
+
+        for i, future in waiting.items():  # only after finishing our own, in case values has duplicates
+            results[i] = future.result()
+
+        return results
+
     return cachingfunc
 
 
-def expensive(mockfunc=None):
-    'Decorator to persistently cache result from func(aipl, *args, **kwargs).  Use as @expensive(mock_func) where mock_func has identical signature to func and returns a compatible result during --dry-run.'
+def expensive(mockfunc=None, batch=False, ttl=None):
+    '''Decorator to persistently cache result from func(aipl, *args, **kwargs).  Use as @expensive(mock_func) where mock_func has identical signature to func and returns a compatible result during --dry-run.
+    With batch=True, func(aipl, values:list, ...) returns a list of results, each cached separately (see dbcache_batch); mock_func is called once per value.
+    Cached results older than *ttl* (seconds, or e.g. "12h") are computed again (see cache_ttl).'''
+    def _mock(aipl:AIPL, func, *args, **kwargs):
+        if mockfunc:
+            return mockfunc(aipl, *args, **kwargs)
+        else:
+            return f'<{func.__name__}({args} {kwargs})>'
+
     def _decorator(func):
+        if batch:
+            cached = dbcache_batch(func, ttl=ttl)
+            @wraps(func)
+            def _bwrapper(aipl:AIPL, values:list, *args, batch_size:int=0, **kwargs):
+                if aipl.options.dry_run:
+                    return [_mock(aipl, func, v, *args, **kwargs) for v in values]
+
+                return cached(aipl, values, *args, batch_size=batch_size, **kwargs)
+
+            _bwrapper.expensive = True
+            return _bwrapper
+
+        cached = dbcache(func, ttl=ttl)
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def _awrapper(aipl:AIPL, *args, **kwargs):
+                if aipl.options.dry_run:
+                    return _mock(aipl, func, *args, **kwargs)
+
+                return await cached(aipl, *args, **kwargs)
+
+            _awrapper.expensive = True
+            _awrapper.cache_table = cached.cache_table
+            return _awrapper
+
         @wraps(func)
         def _wrapper(aipl:AIPL, *args, **kwargs):
             if aipl.options.dry_run:
-                if mockfunc:
-                    return mockfunc(aipl, *args, **kwargs)
-                else:
-                    return f'<{func.__name__}({args} {kwargs})>'
+                return _mock(aipl, func, *args, **kwargs)
 
-            return dbcache(func)(aipl, *args, **kwargs)
+            return cached(aipl, *args, **kwargs)
 
+        _wrapper.expensive = True  # for --plan
+        _wrapper.cache_table = cached.cache_table  # for prefetch
         return _wrapper
     return _decorator
+
+
+def content_key(*args, **kwargs) -> str:
+    'Like cache_key, but first replacing each large str or bytes argument with a fast hash of its contents, so big inputs are hashed once and never serialized.'
+    def _digest(v):
+        if isinstance(v, str) and len(v) > 256:
+            return dict(str=hashlib.blake2b(v.encode('utf-8', 'surrogatepass'), digest_size=20).hexdigest())
+        if isinstance(v, (bytes, bytearray, memoryview)) and len(v) > 256:
+            return dict(bytes=hashlib.blake2b(v, digest_size=20).hexdigest())
+        return v
+    return cache_key(*(_digest(v) for v in args), **{k:_digest(v) for k, v in kwargs.items()})
+
+
+def _memo_where(aipl:AIPL, func) -> tuple:
+    'Return (use memory tier, use persistent tier) for @memoize *func*, according to option memoize (off, mem, or db).'
+    mode = aipl.options.memoize or 'db'
+    if mode not in ('off', 'mem', 'db'):
+        raise AIPLException(f'unknown --memoize "{mode}" (use off, mem, or db)')
+    return mode != 'off', mode == 'db' and func.memo_persist and aipl.cache_db is not None
+
+
+def memo_get(aipl:AIPL, func, args:tuple, kwargs:dict):
+    'Return memoized result of @memoize *func*(aipl, *args, **kwargs), or MISSING.'
+    mem, persist = _memo_where(aipl, func)
+    if not mem:
+        return MISSING
+
+    tbl, key = func.memo_table, content_key(*args, **kwargs)
+    v = aipl.cache_mem.get(('memo', tbl, key), MISSING)
+    if v is MISSING and persist:
+        text = _cache_get(aipl, tbl, key)  # counts in cache_stats
+        return json.loads(text) if isinstance(text, str) else MISSING  # not str if pickled by an older version
+
+    aipl.cache_stats.add(tbl, **(dict(misses=1) if v is MISSING else dict(hits=1)))
+    if v is MISSING:
+        return MISSING
+    kind, obj = v
+    return pickle.loads(obj) if kind == 'pickle' else obj
+
+
+def _memo_json(result) -> str|None:
+    'Return *result* as JSON, or None if it would not come back the same (e.g. bytes, tuples, or non-str dict keys).'
+    try:
+        text = json.dumps(result, ensure_ascii=False)
+    except (TypeError, ValueError):
+        return None
+    return text if json.loads(text) == result else None
+
+
+def memo_put(aipl:AIPL, func, args:tuple, kwargs:dict, result, cost_ms:int=0):
+    'Memoize *result* of @memoize *func*(aipl, *args, **kwargs), which took *cost_ms* to compute.'
+    mem, persist = _memo_where(aipl, func)
+    if not mem:
+        return
+
+    tbl, key = func.memo_table, content_key(*args, **kwargs)
+    if persist:
+        text = _memo_json(result)
+        if text is not None:
+            _cache_put(aipl, tbl, key, text, cost_ms=cost_ms)  # like @dbcache results, so never unpickled from a shared file
+            return
+
+    try:
+        data = pickle.dumps(result)  # so callers can't change the memoized result
+    except Exception:  # e.g. lxml elements; keep the object itself
+        aipl.cache_mem.put(('memo', tbl, key), ('object', result))
+        return
+
+    aipl.cache_mem.put(('memo', tbl, key), ('pickle', data))
+
+
+def memoize(func=None, *, persist=True):
+    '''Decorator to reuse the result of deterministic func(aipl, *args, **kwargs) for arguments with the same contents (see content_key).
+    Results are kept in aipl.cache_mem, and with *persist* (and --memoize=db, the default) also in cache_db as JSON, like @dbcache.
+    A generator's results are collected into a list.  Unlike @expensive, results may be any value (those that aren't JSON are kept in memory only), and calls run even during --dry-run.'''
+    if func is None:
+        return lambda f: memoize(f, persist=persist)
+
+    @wraps(func)
+    def memofunc(aipl:AIPL, *args, **kwargs):
+        result = memo_get(aipl, memofunc, args, kwargs)
+        if result is not MISSING:
+            return result
+
+        start_t = time.time()
+        result = func(aipl, *args, **kwargs)
+        if inspect.isgenerator(result):
+            result = list(result)
+        memo_put(aipl, memofunc, args, kwargs, result, int((time.time()-start_t)*1000))
+        return result
+
+    memofunc.memo_table = 'cached_'+func.__name__  # for cpu_bound operators, see _ProcCall
+    memofunc.memo_persist = persist
+    return memofunc
+
+
+def cache_tables(db:Database) -> list:
+    'Return names of cache tables in *db*.'
+    return [r['name'] for r in db.query("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'cached\\_%' ESCAPE '\\'")]
+
+
+def cache_gc(aipl:AIPL, max_bytes:int=0, evict:str='lru') -> AttrDict:
+    '''Delete expired entries (see cache_ttl) from cache_backend(aipl).
+    Then, if its entries total more than *max_bytes*, delete those least recently used (evict='lru') or least often used ('lfu') until they don't.
+    Finally delete values in blob_dir no longer used by any entry, and compact the backend (for sqlite, rebuild the indexes and VACUUM the database file).  Return counts of what was done.'''
+    backend = cache_backend(aipl)
+    db = aipl.cache_db
+    stats = AttrDict(bytes_before=backend.stats()['bytes'])
+    with db.lock:
+        backend.flush()
+        stats.update(backend.gc(aipl, max_bytes, evict))
+
+        if db.get_table_info(LEASES):
+            db.con.execute(f'DELETE FROM "{LEASES}" WHERE "expires"<?', (time.time(),))
+            db.con.commit()
+
+        stats.blobs_deleted = _gc_blobs(aipl, backend.blob_refs())
+        backend.compact()
+
+    aipl.cache_mem.clear()
+    stats.bytes_after = backend.stats()['bytes']
+    return stats
+
+
+def _gc_blobs(aipl:AIPL, refs:set) -> int:
+    'Delete files in blob_dir not in *refs*.  Return number deleted.'
+    n = 0
+    for dirpath, dirnames, filenames in os.walk(blob_dir(aipl)):
+        for fn in filenames:
+            if fn not in refs and '.' not in fn:  # not being written
+                os.remove(os.path.join(dirpath, fn))
+                n += 1
+    return n
@@ -1,5 +1,9 @@
 from aipl import defop, expensive, stderr, AIPLException
+from aipl.parser import clean_to_id
 import openai
+import asyncio
+import threading
+import time
 import os
 
 # from the horse's mouth, 2023-05-30
@@ -11,7 +15,8 @@ openai_pricing = {
     "text-ada-001": 0.0016,
     "text-babbage-001": 0.0024,
     "text-curie-001": 0.0120,
-    "text-davinci-003": 0.1200
+    "text-davinci-003": 0.1200,
+    "text-embedding-ada-002": 0.0001,
 }
 
 # base price covers the first 25 tokens, then it's the per-token price (2023-06-06)
@@ -54,6 +59,63 @@ def count_tokens(s:str, model:str=''):
         return len(s)//4
 
 
+class RateLimiter:
+    '''Token buckets for requests-per-minute and tokens-per-minute, refilled continuously.
+    Each request reserves its share up front and waits out any shortfall, so requests are spaced evenly just under the limits instead of bursting into 429s.'''
+    def __init__(self, rpm:float=0, tpm:float=0):
+        self.rpm = rpm  # 0 means unlimited
+        self.tpm = tpm
+        self.requests = 1.0  # currently available in bucket; may go negative when reserved ahead
+        self.tokens = tpm/60
+        self.last_t = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        dt = now - self.last_t
+        self.last_t = now
+        # buckets hold at most 1s worth, to avoid a burst at the start of every minute
+        if self.rpm:
+            self.requests = min(max(1, self.rpm/60), self.requests + dt*self.rpm/60)
+        if self.tpm:
+            self.tokens = min(self.tpm/60, self.tokens + dt*self.tpm/60)
+
+    def reserve(self, ntokens:int) -> float:
+        'Take one request and *ntokens* from the buckets.  Return number of seconds to wait before sending it.'
+        with self.lock:
+            self._refill()
+            wait = 0
+            if self.rpm:
+                self.requests -= 1
+                if self.requests < 0:
+                    wait = max(wait, -self.requests*60/self.rpm)
+            if self.tpm:
+                self.tokens -= ntokens
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens*60/self.tpm)
+            return wait
+
+    def settle(self, estimated:int, used:int):
+        'Return (or take) the difference between *estimated* tokens and those actually *used*.'
+        with self.lock:
+            self.tokens += estimated - used
+
+
+def rate_limiter(aipl, model:str) -> RateLimiter|None:
+    'Return RateLimiter shared by all requests to *model* in this run, or None if unlimited.  Limits are options rpm_<model>/tpm_<model> (e.g. tpm_gpt_3_5_turbo), else rpm/tpm.'
+    if not aipl:
+        return None
+    modelid = clean_to_id(model).replace('.', '_')
+    rpm = float(aipl.options.get('rpm_'+modelid) or aipl.options.rpm or 0)
+    tpm = float(aipl.options.get('tpm_'+modelid) or aipl.options.tpm or 0)
+    if not rpm and not tpm:
+        return None
+
+    limiter = aipl.rate_limiters.setdefault(model, RateLimiter(rpm, tpm))
+    limiter.rpm, limiter.tpm = rpm, tpm  # may have been changed by !option
+    return limiter
+
+
 class StandardClient:
     def compute_cost(self, aipl, resp, model):
         if self.client_type == 'openai':
@@ -67,8 +129,8 @@ class StandardClient:
         elif self.client_type == 'selfhosted':
             stderr('Used TODO tokens. Cost: $¯\\_(ツ)_/¯')
 
-    def completion(self, aipl, v:str, **kwargs) -> str:
-        'Send chat messages to GPT.  Lines beginning with @@@s or @@@a are sent as system or assistant messages respectively (default user).  Passes all [named args](https://platform.openai.com/docs/guides/chat/introduction) directly to API.'
+    def _completion_request(self, v:str, **kwargs) -> tuple:
+        'Return (model, params) for ChatCompletion.create from prompt *v* and named args.'
         model = kwargs.get('model') or self.default_model
         temperature = kwargs.get('temperature') or 0
         params = dict(
@@ -104,10 +166,10 @@ class StandardClient:
             else:
                 msgs.append(dict(role=role, content=msg))
 
-        resp = openai.ChatCompletion.create(
-            messages=msgs,
-            **params
-        )
+        params['messages'] = msgs
+        return model, params
+
+    def _completion_result(self, aipl, resp, model) -> str:
         try:
             result = resp['choices'][0]['message']['content']
         except:
@@ -116,6 +178,45 @@ class StandardClient:
 
         return result
 
+    def _estimate_tokens(self, params:dict) -> int:
+        'Estimate total tokens for request, as counted against tokens-per-minute limits.'
+        prompt = '\n'.join(m['content'] for m in params['messages'])
+        return count_tokens(prompt, params['model']) + int(params.get('max_tokens') or 0)
+
+    def _used_tokens(self, resp, estimated:int) -> int:
+        try:
+            return resp['usage']['total_tokens']
+        except (KeyError, TypeError):
+            return estimated
+
+    def completion(self, aipl, v:str, **kwargs) -> str:
+        'Send chat messages to GPT.  Lines beginning with @@@s or @@@a are sent as system or assistant messages respectively (default user).  Passes all [named args](https://platform.openai.com/docs/guides/chat/introduction) directly to API.'
+        model, params = self._completion_request(v, **kwargs)
+        limiter = rate_limiter(aipl, model)
+        if limiter:
+            ntokens = self._estimate_tokens(params)
+            time.sleep(limiter.reserve(ntokens))
+
+        resp = openai.ChatCompletion.create(**params)
+
+        if limiter:
+            limiter.settle(ntokens, self._used_tokens(resp, ntokens))
+        return self._completion_result(aipl, resp, model)
+
+    async def acompletion(self, aipl, v:str, **kwargs) -> str:
+        'Like completion(), without blocking the event loop.'
+        model, params = self._completion_request(v, **kwargs)
+        limiter = rate_limiter(aipl, model)
+        if limiter:
+            ntokens = self._estimate_tokens(params)
+            await asyncio.sleep(limiter.reserve(ntokens))
+
+        resp = await openai.ChatCompletion.acreate(**params)
+
+        if limiter:
+            limiter.settle(ntokens, self._used_tokens(resp, ntokens))
+        return self._completion_result(aipl, resp, model)
+
 
 class GooseClient(StandardClient):
     def __init__(self):
@@ -126,9 +227,8 @@ class GooseClient(StandardClient):
         openai.api_key = os.environ['GOOSE_AI_KEY']
         openai.api_base = "https://api.goose.ai/v1"
 
-    def completion(self, aipl, v, **kwargs):
-        import requests
-
+    def _goose_request(self, v:str, **kwargs) -> tuple:
+        'Return (model, url, headers, data) for a GooseAI completion request.'
         model = kwargs.get('model') or self.default_model
         if 'GOOSE_AI_KEY' not in os.environ:
             raise AIPLException(f'''GOOSE_AI_KEY envvar must be set for !llm to use {model}''')
@@ -142,8 +242,9 @@ class GooseClient(StandardClient):
         params.update(**kwargs)
         # TODO: GooseAI supports multiple prompt completions in parallel
         data = {'prompt': v, **params}
-        r = requests.post(f'https://api.goose.ai/v1/engines/{model}/completions', headers=headers, json=data)
-        j = r.json()
+        return model, f'https://api.goose.ai/v1/engines/{model}/completions', headers, data
+
+    def _goose_result(self, aipl, j, model, v:str) -> str:
         if 'error' in j:
             raise AIPLException(f'''GooseAI returned an error: {j["error"]}''')
 
@@ -157,6 +258,22 @@ class GooseClient(StandardClient):
         stderr(f'Used {used} tokens (estimate {len(v)//4} tokens).  Cost: ${cost:.03f}')
         return response
 
+    def completion(self, aipl, v, **kwargs):
+        import requests
+
+        model, url, headers, data = self._goose_request(v, **kwargs)
+        r = requests.post(url, headers=headers, json=data)
+        return self._goose_result(aipl, r.json(), model, v)
+
+    async def acompletion(self, aipl, v, **kwargs):
+        import aiohttp
+
+        model, url, headers, data = self._goose_request(v, **kwargs)
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, headers=headers, json=data) as r:
+                j = await r.json()
+        return self._goose_result(aipl, j, model, v)
+
 
 class OpenAIClient(StandardClient):
     def __init__(self):
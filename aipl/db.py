@@ -1,7 +1,11 @@
 from functools import cached_property
 import sys
 import json
+import time
+import atexit
 import sqlite3
+import threading
+import weakref
 
 from .utils import AttrDict
 
@@ -29,15 +33,42 @@ def sqlite_type(v):
     return 'TEXT'
 
 
+def is_locked(e:Exception) -> bool:
+    'True if *e* is from another connection (maybe another process) holding a lock on the database.'
+    return isinstance(e, sqlite3.OperationalError) and ('locked' in str(e) or 'busy' in str(e))
+
+
+_open_dbs = weakref.WeakSet()  # flushed at exit
+
+@atexit.register
+def _flush_all():
+    for db in list(_open_dbs):
+        db.flush()
+
+
 class Database:
-    def __init__(self, dbfn):
+    '''Writes are not committed one by one, but together: after *batch_rows* rows or *batch_secs* seconds, at flush(), and at exit.
+    Rows given to buffer() are held back until then too, and inserted with one executemany.
+    Several processes may use the same database file; a statement waits up to *busy_timeout* seconds for another to release its lock.'''
+    def __init__(self, dbfn, batch_rows:int=1000, batch_secs:float=1.0, busy_timeout:float=30):
         self.dbfn = dbfn
         self.tables = {}  # tablename -> { colname -> { .type:str, ... } }
+        self.lock = threading.RLock()  # operators may run concurrently (see defop io_bound)
+        self.batch_rows = batch_rows
+        self.batch_secs = batch_secs
+        self.busy_timeout = busy_timeout
+        self.pending = {}  # tablename -> list of rows to insert at next flush (see buffer)
+        self.uncommitted = 0  # number of rows written since last commit
+        self.last_commit = time.monotonic()
+        self._flush_timer = None  # so an idle writer doesn't hold the write lock for long
+        _open_dbs.add(self)
 
     @cached_property
     def con(self):
-        con = sqlite3.connect(self.dbfn)
+        con = sqlite3.connect(self.dbfn, check_same_thread=False, timeout=self.busy_timeout)
         con.row_factory = dict_factory
+        con.execute('PRAGMA journal_mode=WAL')  # readers don't block the writer
+        con.execute('PRAGMA synchronous=NORMAL')  # fsync at checkpoints only; safe with WAL
         return con
 
     def __enter__(self):
@@ -45,9 +76,57 @@ class Database:
 
     def __exit__(self, type, value, tb):
         if not tb:
-            self.con.commit()
+            self.flush()
         return False
 
+    def flush(self):
+        'Insert buffered rows and commit.'
+        with self.lock:
+            if self._flush_timer:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._write_pending()
+            if self.uncommitted or ('con' in self.__dict__ and self.con.in_transaction):
+                self._retry(self.con.commit)
+            self.uncommitted = 0
+            self.last_commit = time.monotonic()
+
+    def _retry(self, func, *args):
+        'Return func(*args), retrying for up to busy_timeout seconds while the database is locked.'
+        deadline = time.monotonic() + self.busy_timeout
+        delay = 0.01
+        while True:
+            try:
+                return func(*args)
+            except sqlite3.OperationalError as e:
+                if not is_locked(e) or time.monotonic() > deadline:
+                    raise
+            time.sleep(delay)
+            delay = min(delay*2, 1)
+
+    def _write_pending(self):
+        while self.pending:
+            tblname, rows = self.pending.popitem()
+            self._insert_many(tblname, rows)
+
+    def _wrote(self, n:int):
+        'Count *n* rows written, and commit if enough rows or time have gone by.'
+        self.uncommitted += n
+        if self._due():
+            self.flush()
+        else:
+            self._flush_later()
+
+    def _flush_later(self):
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.batch_secs, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _due(self, n:int=0) -> bool:
+        'Return True if it is time to commit, with *n* more rows to write.'
+        return self.uncommitted + n >= self.batch_rows or time.monotonic() - self.last_commit >= self.batch_secs
+
     def get_table_info(self, tblname:str):
         if tblname not in self.tables:
             tinfo = self.query(f'PRAGMA table_info("{tblname}")')
@@ -59,16 +138,91 @@ class Database:
         return self.tables[tblname]
 
     def insert(self, tblname, **kwargs):
+        with self.lock:
+            return self._insert(tblname, kwargs)
+
+    def upsert(self, tblname, **kwargs):
+        'Insert row, replacing any existing row with the same value in a unique column (see create_index).'
+        with self.lock:
+            return self._insert(tblname, kwargs, verb='INSERT OR REPLACE')
+
+    def buffer(self, tblname, **kwargs):
+        'Insert row at the next flush, along with the other rows buffered for *tblname*.'
+        with self.lock:
+            rows = self.pending.setdefault(tblname, [])
+            rows.append(kwargs)
+            if self._due(len(rows)):
+                self.flush()
+            else:
+                self._flush_later()
+        return kwargs
+
+    def insert_many(self, tblname, rows:list):
+        'Insert all *rows* (dicts) into *tblname*.'
+        with self.lock:
+            self._insert_many(tblname, rows)
+
+    def _create_table(self, tblname, row:dict):
         if tblname not in self.tables:
-            fieldstr = ', '.join(f'"{k}" {sqlite_type(v)}' for k,v in kwargs.items())
+            fieldstr = ', '.join(f'"{k}" {sqlite_type(v)}' for k,v in row.items())
             self.con.execute(f'CREATE TABLE IF NOT EXISTS "{tblname}" ({fieldstr})')
+            self.get_table_info(tblname)
 
+    def _insert(self, tblname, kwargs:dict, verb='INSERT'):
+        self._create_table(tblname, kwargs)
         fieldnames = ','.join(f'"{x}"' for x in kwargs.keys())
         valholders = ','.join(['?']*len(kwargs))
-        self.con.execute(f'INSERT INTO "{tblname}" ({fieldnames}) VALUES ({valholders})', tuple(pyobj_to_sqlite(v) for v in kwargs.values()))
-        self.con.commit()
+        self._retry(self.con.execute, f'{verb} INTO "{tblname}" ({fieldnames}) VALUES ({valholders})', tuple(pyobj_to_sqlite(v) for v in kwargs.values()))
+        self._wrote(1)
         return kwargs
 
+    def _insert_many(self, tblname, rows:list):
+        if not rows:
+            return
+        self._create_table(tblname, rows[0])
+        bycols = {}  # tuple of colnames -> list of value tuples; one executemany each
+        for row in rows:
+            bycols.setdefault(tuple(row.keys()), []).append(tuple(pyobj_to_sqlite(v) for v in row.values()))
+
+        for colnames, values in bycols.items():
+            fieldnames = ','.join(f'"{x}"' for x in colnames)
+            valholders = ','.join(['?']*len(colnames))
+            self._retry(self.con.executemany, f'INSERT INTO "{tblname}" ({fieldnames}) VALUES ({valholders})', values)
+        self._wrote(len(rows))
+
+    def execute(self, qstr, *args):
+        'Execute statement that changes data; committed along with the rows written around it.'
+        with self.lock:
+            self._write_pending()
+            cur = self._retry(self.con.execute, qstr, args)
+            self._wrote(1)
+            return cur
+
+    def has_index(self, tblname, idxname) -> bool:
+        return any(r['name'] == idxname for r in self.query(f'PRAGMA index_list("{tblname}")'))
+
+    def create_index(self, tblname, colname, unique=False) -> str:
+        'Create index on *colname* of *tblname*, if not already there.  Return index name.'
+        idxname = f'{tblname}_{colname}'
+        with self.lock:
+            self.con.execute(f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS "{idxname}" ON "{tblname}" ("{colname}")')
+            self.con.commit()
+        return idxname
+
+    def executemany(self, qstr, rows:list):
+        'Execute statement that changes data once for each of *rows* (tuples of parameters).'
+        with self.lock:
+            self._write_pending()
+            self._retry(self.con.executemany, qstr, rows)
+            self._wrote(len(rows))
+
+    def drop(self, tblname):
+        with self.lock:
+            self.pending.pop(tblname, None)
+            self.con.execute(f'DROP TABLE IF EXISTS "{tblname}"')
+            self.tables.pop(tblname, None)
+            self.flush()
+
     def table(self, tblname):
         return self.query(f'SELECT * FROM "{tblname}"')
 
@@ -86,14 +240,33 @@ class Database:
                     for k, v in row.items()
                 ) for row in results]
 
-    def query(self, qstr, *args):
-        try:
-            cur = self.con.cursor()
-            res = cur.execute(qstr, args)
-            return res.fetchall()
-        except sqlite3.OperationalError as e:
-            print(e, file=sys.stderr)
+    def select_in(self, tblname, colname, values:list, chunksize:int=500):
+        'Return rows of *tblname* with any of *values* in *colname*, in a few queries of at most *chunksize* values each.'
+        tinfo = self.get_table_info(tblname)
+        if not tinfo:
             return []
 
+        ret = []
+        for i in range(0, len(values), chunksize):
+            chunk = values[i:i+chunksize]
+            results = self.query(f'SELECT * FROM "{tblname}" WHERE "{colname}" IN ({",".join(["?"]*len(chunk))})', *chunk)
+            ret.extend(AttrDict((k, sqlite_to_pyobj(v, tinfo[k]['type']))
+                            for k, v in row.items()
+                        ) for row in results)
+        return ret
+
+    def query(self, qstr, *args):
+        with self.lock:
+            self._write_pending()  # so they can be read back
+            try:
+                return self._retry(lambda: self.con.execute(qstr, args).fetchall())
+            except sqlite3.OperationalError as e:
+                if is_locked(e):
+                    raise
+                print(e, file=sys.stderr)
+                return []
+
     def sql(self, qstr):
-        return self.con.execute(qstr)
+        with self.lock:
+            self._write_pending()
+            return self.con.execute(qstr)
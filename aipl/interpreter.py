@@ -1,17 +1,27 @@
 from typing import List, Mapping, Callable
 from copy import copy
 from dataclasses import dataclass
-from functools import wraps
-from itertools import cycle
+from functools import wraps, cached_property
+from itertools import cycle, islice, count
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import importlib
+import asyncio
+import contextvars
+import threading
+import queue
+import sys
 import time
 import inspect
 
 from aipl import Error, AIPLException, InnerPythonException
 from .table import Table, LazyRow, Column
 from .db import Database
-from .utils import stderr, fmtargs, fmtkwargs, AttrDict
+from .utils import stderr, fmtargs, fmtkwargs, AttrDict, SingleFlight, LRUCache, CacheStats
 from .parser import clean_to_id, Command
 from . import parser
+from . import planner
 
 
 Scalar = int|float|str
@@ -30,13 +40,123 @@ def rank(v):
         return 0
 
 
+class _Immediate:
+    'Run func(*args, **kwargs) right away; quacks like a Future for eval_op.'
+    def __init__(self, func, *args, **kwargs):
+        self.value = func(*args, **kwargs)
+
+    def result(self):
+        return self.value
+
+
+class _ProcCall:
+    'Run cmd.op in a worker process of aipl.procpool; quacks like a Future for eval_op.'
+    def __init__(self, aipl, cmd:Command, contexts:List[Mapping], *inputs, newkey=''):
+        self.aipl = aipl
+        self.cmd = cmd
+        self.inputs = inputs
+        self.newkey = newkey
+        operands, args, kwargs = aipl._prep_call(cmd, contexts, *inputs)
+        self.memo = None  # (args, kwargs) to memoize result with, if @memoize
+        if getattr(cmd.op.func, 'memo_table', None):
+            from .caching import memo_get, MISSING
+            self.memo = ((*operands, *args), kwargs)
+            self.value = memo_get(aipl, cmd.op.func, *self.memo)
+            if self.value is not MISSING:
+                self.future = None  # no need to bother a worker
+                return
+
+        self.future = aipl.procpool.submit(_proc_call, cmd.op.func.__module__, cmd.op.opname, operands, args, kwargs)
+
+    def result(self):
+        if self.future is None:
+            return self.aipl._annotate_ret(self.cmd, self.inputs, self.value, 0, 0, newkey=self.newkey)
+
+        try:
+            ret, cost_usd, cost_ms = self.future.result()
+        except Exception as e:
+            if self.aipl.options.debug or self.aipl.options.test:
+                raise
+            return Error(self.cmd.linenum, self.cmd.opname, e)
+
+        if self.memo:
+            from .caching import memo_put
+            memo_put(self.aipl, self.cmd.op.func, *self.memo, ret, cost_ms)
+
+        return self.aipl._annotate_ret(self.cmd, self.inputs, ret, cost_usd, cost_ms, newkey=self.newkey)
+
+
+_worker_aipl = None
+
+def _proc_call(modname:str, opname:str, operands, args, kwargs):
+    'Call operator *opname* (defined in module *modname*) in this worker process.  Return (result, cost_usd, cost_ms).'
+    global _worker_aipl
+    if _worker_aipl is None:
+        _worker_aipl = AIPL(memoize='off')  # @memoize is done by the parent process (see _ProcCall)
+    importlib.import_module(modname)
+
+    start_t = time.time()
+    ret = AIPL.operators[opname](_worker_aipl, *operands, *args, **kwargs)
+    if inspect.isgenerator(ret):
+        ret = list(ret)
+    cost_ms = int((time.time()-start_t)*1000)
+
+    cost_usd, _worker_aipl.cost_usd = _worker_aipl.cost_usd, 0
+    return ret, cost_usd, cost_ms
+
+
+_END = object()
+
+def pipeline_stage(source, maxsize:int, name:str=''):
+    '''Start pulling rows from iterator *source* in a separate thread, at most *maxsize* ahead of those consumed.  Return generator of them in order.
+    Exceptions from *source* are raised to the consumer.  Closing this generator stops the thread (and closes *source*).'''
+    q = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce():
+        try:
+            for row in source:
+                if not _put((row, None)):
+                    break
+            else:
+                _put((_END, None))
+        except BaseException as e:
+            _put((_END, e))
+        finally:
+            if hasattr(source, 'close'):
+                source.close()
+
+    def _consume():
+        try:
+            while True:
+                row, exc = q.get()
+                if exc is not None:
+                    raise exc
+                if row is _END:
+                    return
+                yield row
+        finally:
+            stop.set()
+
+    threading.Thread(target=_produce, name=name, daemon=True).start()
+    return _consume()
+
+
 class AIPL:
     operators = {}  # opname:str -> func(aipl, ..., *args, *kwargs)
     aliases = {}  # aliasname:str -> builtinopname:str
-    next_unique_key:int = 0
-    cost_usd:float = 0.0
 
     def __init__(self, **kwargs):
+        self._cost_usd = contextvars.ContextVar('cost_usd', default=0.0)  # per thread/task, so concurrent rows don't mix their costs
         self.tables = {}  # named tables
         self.globals = dict(  # base context, imports go into here for later use in the whole script
             aipl=self,
@@ -49,14 +169,80 @@ class AIPL:
         self.output_db = Database(self.options.outdbfn)
         self.cache_db = None
         if self.options.cachedbfn:
+            from .caching import write_codec, cache_backend
             self.cache_db = Database(self.options.cachedbfn)
+            write_codec(self)  # warn now, not after the first result to cache
+            cache_backend(self)  # likewise fail now if it can't be opened
+        self._procpool = None
+        self._event_loop = None
+        self._unique_keys = count()  # next() is atomic, so threads of a --pipeline never get the same key
+        self.rate_limiters = {}  # model -> clients.RateLimiter, shared by all commands in this run
+        self.single_flight = SingleFlight()  # @dbcache calls in progress
+        self.cache_stats = CacheStats()  # @dbcache hits, misses, and savings by cache table
+        self.cache_mem = LRUCache(int(self.options.get('cache_mem_entries', 1000)),  # recently used @dbcache results, in front of cache_db
+                                  int(self.options.get('cache_mem_bytes', 64*2**20)))
+        self.prefetched = {}  # rows loaded by prefetch_cached for the current command, by the same key as in cache_mem; not bounded like cache_mem
+
+
+    def flush(self):
+        'Commit writes pending in output_db and cache_db (and its cache backend).'
+        self.output_db.flush()
+        if self.cache_db:
+            from .caching import cache_backend
+            self.cache_db.flush()
+            cache_backend(self).flush()
+
+    @property
+    def cost_usd(self) -> float:
+        return self._cost_usd.get()
+
+    @cost_usd.setter
+    def cost_usd(self, v:float):
+        self._cost_usd.set(v)
+
+    def op_workers(self, cmd:Command) -> int:
+        'Return max number of rows of io_bound *cmd* to run at once: `workers=` on the command, else --max-tasks (async ops) or --max-workers (threads).'
+        if not cmd.op.io_bound:
+            return 1
+        if self.options.step and 'break' in self.options.step.split(','):
+            return 1
+        default = self.options.max_tasks if cmd.op.is_async else self.options.max_workers
+        return int(cmd.kwargs.get('workers') or default or 1)
+
+    def op_procs(self, cmd:Command) -> int:
+        'Return number of worker processes to use for rows of cpu_bound *cmd* (--procs), or 1 to run them in this process.'
+        if not cmd.op.cpu_bound:
+            return 1
+        if not getattr(sys.modules.get(cmd.op.func.__module__), '__file__', None):
+            return 1  # defined in script; worker processes could not import it
+        if self.options.step and 'break' in self.options.step.split(','):
+            return 1
+        return int(self.options.procs or 1)
+
+    @property
+    def procpool(self) -> ProcessPoolExecutor:
+        'Worker processes for cpu_bound operators, started on first use and kept for the rest of the run.'
+        if self._procpool is None:
+            self._procpool = ProcessPoolExecutor(max_workers=int(self.options.procs),
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._procpool
+
+    @property
+    def event_loop(self) -> asyncio.AbstractEventLoop:
+        'Event loop for async operators, run forever in its own thread, so their rows can be awaited from any command (and streamed).'
+        if self._event_loop is None:
+            self._event_loop = asyncio.new_event_loop()
+            threading.Thread(target=self._event_loop.run_forever, name='aipl-event-loop', daemon=True).start()
+        return self._event_loop
 
+    @property
+    def streaming(self) -> bool:
+        'True if rows are pulled through commands as needed (--stream or --pipeline).'
+        return bool(self.options.stream or self.options.pipeline)
 
     @property
     def unique_key(self) -> str:
-        r = self.next_unique_key
-        self.next_unique_key += 1
-        return f'_{r}'
+        return f'_{next(self._unique_keys)}'
 
     def step_breakpoint(self, cmd:Command, *inputs:List[Table]):
         breakpoint()
@@ -108,13 +294,22 @@ class AIPL:
         # also add nop at end to do final single-steps.
         cmds = self.parse('!!python\n' + script + '\n!nop')
 
+        if self.options.plan or self.options.explain:
+            planned = planner.plan(cmds) if self.options.plan else cmds
+            if self.options.explain:
+                stderr(planner.explain(cmds, planned, self.fusable))
+            cmds = planned
+
         return self.run_cmdlist(cmds, inputs)
 
     def pre_command(self, cmd:Command, t:Table=Table(), *args):
         stderr(t, str(cmd))
 
     def run_cmdlist(self, cmds:List[Command], inputs:List[Table]):
-        for cmd in cmds:
+        i = 0
+        while i < len(cmds):
+            cmd = cmds[i]
+            i += 1
             if self.forced_input is not None:
                 inputs.append(self.forced_input)
                 self.forced_input = None
@@ -136,6 +331,9 @@ class AIPL:
                 t.columns.remove(col)
                 t.add_column(col)
 
+            fused = self._fusable_run(cmds, i-1, operands)  # following commands to evaluate in the same pass over the rows
+            i += len(fused)
+
             self.pre_command(cmd, *operands)
 
             if self.options.step:
@@ -147,11 +345,18 @@ class AIPL:
                         stderr(f'no aipl.step_{stepfuncname}!')
 
             try:
-                annotated_result = self.eval_op(cmd, *operands, contexts=[self.globals, self.tables])
+                if fused:
+                    annotated_result = self.eval_fused([cmd, *fused], operands[0], contexts=[self.globals, self.tables])
+                    cmd = fused[-1]
+                else:
+                    annotated_result = self.eval_op(cmd, *operands, contexts=[self.globals, self.tables])
                 result = annotated_result['result']
                 if cmd.op.rankout is None:
                     continue # just keep former inputs
                 elif isinstance(result, Table):
+                    if self.options.pipeline and result.source is not None:
+                        # pull rows for this command in its own thread, so it runs at the same time as the commands after it
+                        result.source = pipeline_stage(result.source, int(self.options.pipeline), name=f'aipl-{cmd.opname}')
                     inputs = [result]
                 else:
                     k = cmd.varnames[-1] if cmd.varnames else self.unique_key
@@ -161,39 +366,141 @@ class AIPL:
                     self.tables[g] = inputs[-1]
 
             except AIPLException as e:
+                cmd = getattr(e, 'command', cmd)
                 raise AIPLException(f'AIPL Error (line {cmd.linenum} !{cmd.opname}): {e}') from e
             except Exception as e:
+                cmd = getattr(e, 'command', cmd)
                 raise Exception(f'AIPL Error (line {cmd.linenum} !{cmd.opname}): {e}') from e
+            finally:
+                self.prefetched.clear()
+                self.flush()
 
         for result in inputs:
+            if isinstance(result, Table):
+                len(result)  # with --stream, pull the rest of the rows through all commands
+
             if isinstance(result, Error):
                 if isinstance(result.exception, InnerPythonException):
                     result.exception.command = command
                 raise result.exception
 
+        self.flush()
+
         return inputs
 
-    def call_cmd(self, cmd:Command, contexts:List[Mapping], *inputs, newkey=''):
+    def fusable(self, cmd:Command) -> bool:
+        'True if *cmd* can be evaluated in the same pass over the rows as the scalar commands around it (see eval_fused).'
+        op = cmd.op
+        if op.rankin not in (0, 0.5) or op.rankout != 0 or op.rankin2 not in (None, 0):
+            return False
+        if op.io_bound or op.cpu_bound:
+            return False
+        if cmd.prompt is not None and op.arity == 1:
+            return False  # prompt would replace the input table
+        return not (cmd.globals or cmd.input_tables or cmd.input_cols)
+
+    def _fusable_run(self, cmds:List[Command], i:int, operands:list) -> List[Command]:
+        'Return commands following cmds[i] to be evaluated together with it by eval_fused, if any.'
+        if self.options.step or self.streaming:
+            return []
+        if not operands or not isinstance(operands[0], Table) or operands[0].rank == 0:
+            return []
+        if not self.fusable(cmds[i]):
+            return []
+
+        j = i+1
+        while j < len(cmds) and self.fusable(cmds[j]):
+            j += 1
+        return cmds[i+1:j]
+
+    def eval_fused(self, cmds:List[Command], t:Table, contexts=[]) -> dict:
+        '''Evaluate consecutive scalar commands (rankin 0 or 0.5, rankout 0) in one pass over the rows of *t*, instead of one pass each.
+        Return dict(result=, cost_usd=, cost_ms=) for the last command, with the same columns as if each command were evaluated by eval_op.'''
+        extra_operands = []
+        for cmd in cmds:
+            operands = [Table(cmd.prompt)] if cmd.prompt is not None else []
+            operands += [Table() for i in range(cmd.op.arity-1-len(operands))]
+            extra_operands.append(operands)
+
+        return self._eval_fused(cmds, extra_operands, t, [contexts]*len(cmds), ['']*len(cmds))[-1]
+
+    def _eval_fused(self, cmds:List[Command], extra_operands:List[list], t:Table|LazyRow, contexts:List[List[Mapping]], newkeys:List[str]) -> List[dict]:
+        'Return list of dict(result=, cost_usd=, cost_ms=), one for each of *cmds*, for rows of *t* (or of its value).'
+        tbl = t if isinstance(t, Table) else t.value
+        rets = [copy(tbl) for cmd in cmds]
+        added = [False]*len(cmds)  # columns added to rets yet
+        costs = [[0, 0] for cmd in cmds]
+
+        keys = []
+        for cmd, newkey in zip(cmds, newkeys):
+            # same as _eval_op
+            if len(cmd.varnames) > cmd.op.rankout and rank(t) == int(cmd.op.rankin+1):
+                keys.append(cmd.varnames[0] or self.unique_key)
+            else:
+                keys.append(newkey or self.unique_key)
+
+        for row in tbl:
+            rowdict = row._row
+            inrows = [row]  # the row as given to each of cmds, in the table of the one before
+            if rank(row) > cmds[0].op.rankin:
+                inrows += [LazyRow(ret, rowdict) for ret in rets[:-1]]
+                subresults = self._eval_fused(cmds, extra_operands, row,
+                                              [ctx+[inrow] for ctx, inrow in zip(contexts, inrows)],
+                                              keys)
+            else:
+                subresults = None
+
+            for i, cmd in enumerate(cmds):
+                if subresults:
+                    annotated_x = subresults[i]
+                else:
+                    if i > 0:
+                        inrows.append(LazyRow(rets[i-1], rowdict))
+                    try:
+                        annotated_x = self.call_cmd(cmd, contexts[i]+[inrows[i]], inrows[i], *extra_operands[i], newkey=keys[i])
+                    except Exception as e:
+                        e.command = cmd  # for error message in run_cmdlist
+                        raise
+
+                x = annotated_x['result']
+                if x is None:
+                    break  # row is dropped, as with _eval_op
+
+                update_dict(rowdict, x, keys[i])
+                cost = dict(usd=annotated_x['cost_usd'], ms=annotated_x['cost_ms'])
+                if '_costs' in rowdict:
+                    rowdict['_costs'].rows.append(cost)  # already has these columns
+                else:
+                    rowdict['_costs'] = Table([cost])
+                if not added[i]:
+                    for ret in rets[i:]:
+                        ret.add_column(Column('_costs'))
+                        ret.add_column(Column(keys[i]))
+                    added[i] = True
+
+                rets[i].rows.append(rowdict)
+                costs[i][0] += annotated_x['cost_usd']
+                costs[i][1] += annotated_x['cost_ms']
+
+        return [dict(result=ret, cost_usd=cost_usd, cost_ms=cost_ms) for ret, (cost_usd, cost_ms) in zip(rets, costs)]
+
+    def _prep_call(self, cmd:Command, contexts:List[Mapping], *inputs) -> tuple:
+        'Return (operands, args, kwargs) to pass to cmd.op.'
         operands = [prep_input(arg, rank)
                       for arg,rank in zip(inputs,
                                           [cmd.op.rankin, cmd.op.rankin2])
                    ]
         args = fmtargs(cmd.args, contexts)
         kwargs = fmtkwargs(cmd.kwargs, contexts)
+        if cmd.op.io_bound:
+            kwargs.pop('workers', None)
 
+        if self.options.step and 'break' in self.options.step.split(','):
+            breakpoint()
 
-        try:
-            if self.options.step and 'break' in self.options.step.split(','):
-                breakpoint()
-            start_t = time.time()
-            ret = cmd.op(self, *operands, *args, **kwargs)
-        except Exception as e:
-            if self.options.debug or self.options.test:
-                raise
-            return Error(cmd.linenum, cmd.opname, e)
-
-        end_t = time.time()
+        return operands, args, kwargs
 
+    def _annotate_ret(self, cmd:Command, inputs, ret, cost_usd:float, cost_ms:int, newkey='') -> dict:
         if cmd.op.rankout is not None and cmd.varnames:
             varname = cmd.varnames[-1]
         else:
@@ -206,15 +513,121 @@ class AIPL:
                            cmd.op.outcols.split(),
                            varname)
 
-        annotated_ret = dict(result=result, cost_usd=self.cost_usd, cost_ms=int((end_t-start_t)*1000))
-        self.cost_usd = 0
-        return annotated_ret
+        return dict(result=result, cost_usd=cost_usd, cost_ms=cost_ms)
+
+    def call_cmd(self, cmd:Command, contexts:List[Mapping], *inputs, newkey=''):
+        operands, args, kwargs = self._prep_call(cmd, contexts, *inputs)
+        try:
+            start_t = time.time()
+            ret = cmd.op(self, *operands, *args, **kwargs)
+        except Exception as e:
+            if self.options.debug or self.options.test:
+                raise
+            return Error(cmd.linenum, cmd.opname, e)
+
+        cost_ms = int((time.time()-start_t)*1000)
+        cost_usd, self.cost_usd = self.cost_usd, 0
+        return self._annotate_ret(cmd, inputs, ret, cost_usd, cost_ms, newkey=newkey)
+
+    async def acall_cmd(self, cmd:Command, contexts:List[Mapping], *inputs, newkey=''):
+        'Like call_cmd, for async operators.'
+        operands, args, kwargs = self._prep_call(cmd, contexts, *inputs)
+        try:
+            start_t = time.time()
+            ret = await cmd.op(self, *operands, *args, **kwargs)
+        except Exception as e:
+            if self.options.debug or self.options.test:
+                raise
+            return Error(cmd.linenum, cmd.opname, e)
+
+        cost_ms = int((time.time()-start_t)*1000)
+        cost_usd, self.cost_usd = self.cost_usd, 0
+        return self._annotate_ret(cmd, inputs, ret, cost_usd, cost_ms, newkey=newkey)
 
     def eval_op(self, cmd:Command, *operands:List[Table|LazyRow], contexts=[], newkey='') -> dict:
-        'Recursively evaluate cmd.op(t) with cmd args formatted with contexts.  Return dict(result:Table, cost_usd:float, cost_ms:int)'
+        '''Recursively evaluate cmd.op(t) with cmd args formatted with contexts.  Return dict(result:Table, cost_usd:float, cost_ms:int)
+        With --stream, the result Table gets its rows from the input as they are pulled from it (cost_usd and cost_ms are then unknown).'''
+        stream = self.streaming and cmd.op.rankout is not None  # taps have to run now
+
+        if not stream and cmd.op.arity == 1 and getattr(cmd.op.func, 'cache_table', None):
+            self.prefetch_cached(cmd, operands[0], contexts)
+
+        if cmd.op.is_async:
+            return self._aeval_op(cmd, *operands, contexts=contexts, newkey=newkey, stream=stream)
+
+        procs = self.op_procs(cmd)
+        if procs > 1:
+            submit = lambda *args, **kwargs: _ProcCall(self, *args, **kwargs)
+            return self._eval_op(cmd, *operands, contexts=contexts, newkey=newkey, submit=submit, window=stream and 2*procs)()
+
+        workers = self.op_workers(cmd)
+        if workers <= 1:
+            submit = lambda *args, **kwargs: _Immediate(self.call_cmd, *args, **kwargs)
+            return self._eval_op(cmd, *operands, contexts=contexts, newkey=newkey, submit=submit, window=stream and 1)()
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        submit = lambda *args, **kwargs: executor.submit(self.call_cmd, *args, **kwargs)
+        if stream:
+            return self._eval_op(cmd, *operands, contexts=contexts, newkey=newkey, submit=submit, window=2*workers, done=executor.shutdown)()
+
+        with executor:
+            return self._eval_op(cmd, *operands, contexts=contexts, newkey=newkey, submit=submit)()
+
+    def prefetch_cached(self, cmd:Command, t:Table, contexts=[]):
+        'Load cached results for all calls of @expensive cmd.op on *t* at once, so that only the misses go to the operator (see caching.prefetch).'
+        if not self.cache_db or self.options.dry_run or self.options.step:
+            return
+
+        from .caching import prefetch
+
+        calls = []  # (args, kwargs) to cmd.op.func, after aipl
+        def _collect(t, contexts):
+            if rank(t) <= cmd.op.rankin:
+                operands, args, kwargs = self._prep_call(cmd, contexts, t)
+                calls.append(((*operands, *args), kwargs))
+            else:
+                for row in t:
+                    _collect(row, contexts+[row])
+
+        _collect(t, contexts)
+        if len(calls) > 1:
+            ncached, nmissing = prefetch(self, cmd.op.func, calls)
+            stderr(f'!{cmd.opname}: {ncached} cached / {nmissing} to compute')
+
+    def _aeval_op(self, cmd:Command, *operands:List[Table|LazyRow], contexts=[], newkey='', stream=False) -> dict:
+        'Run calls of async cmd.op as tasks on self.event_loop, at most op_workers(cmd) at once.  Cancel the rest if any of them raises.'
+        workers = self.op_workers(cmd)
+        sem = asyncio.Semaphore(workers)
+        futures = []
+
+        async def _limited(*args, **kwargs):
+            async with sem:
+                return await self.acall_cmd(*args, **kwargs)
+
+        def submit(*args, **kwargs):
+            future = asyncio.run_coroutine_threadsafe(_limited(*args, **kwargs), self.event_loop)
+            futures.append(future)
+            return future
+
+        def cancel():
+            for future in futures:
+                future.cancel()
+
+        if stream:
+            return self._eval_op(cmd, *operands, contexts=contexts, newkey=newkey, submit=submit, window=2*workers, done=cancel)()
+
+        try:
+            return self._eval_op(cmd, *operands, contexts=contexts, newkey=newkey, submit=submit)()
+        except BaseException:
+            cancel()
+            raise
+
+    def _eval_op(self, cmd:Command, *operands:List[Table|LazyRow], contexts=[], newkey='', submit=None, window:int=0, done:Callable=None) -> Callable[[], dict]:
+        '''Submit all calls of cmd.op via submit(cmd, contexts, *inputs, newkey=) first, then return function to gather results into dict(result=, cost_usd=, cost_ms=) in input order.
+        With window>0, instead stream the rows of the result, submitting calls for at most *window* input rows ahead of those pulled; call done() after the last one.'''
 
         if cmd.op.arity == 0:
-            return self.call_cmd(cmd, contexts, newkey=newkey)
+            return submit(cmd, contexts, newkey=newkey).result
 
         else:
             if len(operands) < cmd.op.arity:
@@ -222,7 +635,7 @@ class AIPL:
 
             t = operands[0]
             if rank(t) <= cmd.op.rankin:
-                return self.call_cmd(cmd, contexts, *operands, newkey=newkey)
+                return submit(cmd, contexts, *operands, newkey=newkey).result
 
             if isinstance(t, Table):
                 ret = copy(t)
@@ -235,19 +648,18 @@ class AIPL:
             else:
                 newkey = newkey or self.unique_key
 
-            start_t = time.time()
-            cost_usd = 0
-            for row in t:
-                annotated_x = self.eval_op(cmd, row, *operands[1:], contexts=contexts+[row], newkey=newkey)
+            def _submit_row(row):
+                return row, self._eval_op(cmd, row, *operands[1:], contexts=contexts+[row], newkey=newkey, submit=submit)
+
+            def _output_row(row, annotated_x):
+                'Return output row for input *row*, or None if there is none.'
                 x = annotated_x['result']
 
                 if x is None:
-                    continue
+                    return None
 
                 subresult = update_dict(row._row, x, newkey)
-                cost_usd += annotated_x['cost_usd']
                 subresult.setdefault('_costs', Table()).append(dict(usd=annotated_x['cost_usd'], ms=annotated_x['cost_ms']))
-                ret.rows.append(subresult)
 
                 ret.add_column(Column('_costs'))
 
@@ -257,9 +669,46 @@ class AIPL:
                 else:
                     ret.add_column(Column(newkey))
 
-            end_t = time.time()
+                return subresult
+
+            if window:
+                def _stream():
+                    pending = deque()
+                    rows = iter(t)
+                    try:
+                        while True:
+                            for row in islice(rows, window-len(pending)):
+                                pending.append(_submit_row(row))
+                            if not pending:
+                                break
+                            row, get_result = pending.popleft()
+                            subresult = _output_row(row, get_result())
+                            if subresult is not None:
+                                yield subresult
+                    finally:
+                        if done:
+                            done()
+
+                ret.stream(_stream())
+                return lambda: dict(result=ret, cost_usd=None, cost_ms=None)
+
+            start_t = time.time()
+            pending = [_submit_row(row) for row in t]
+
+            def _gather() -> dict:
+                cost_usd = 0
+                for row, get_result in pending:
+                    annotated_x = get_result()
+                    subresult = _output_row(row, annotated_x)
+                    if subresult is not None:
+                        cost_usd += annotated_x['cost_usd']
+                        ret.rows.append(subresult)
+
+                end_t = time.time()
 
-            return dict(result=ret, cost_usd=cost_usd, cost_ms=int((end_t-start_t)*1000))
+                return dict(result=ret, cost_usd=cost_usd, cost_ms=int((end_t-start_t)*1000))
+
+            return _gather
 
 
 def update_dict(d:dict, elem, key:str='') -> dict:
@@ -334,6 +783,9 @@ def prep_output(aipl,
     elif rankout == 1:
         ret = Table()
         if isinstance(in_row, LazyRow):
+            if aipl.streaming and not isinstance(out, (list, tuple)):
+                ret.add_column(Column(varname))
+                return ret.stream({'__parent': in_row, varname:v} for v in out)
             ret.rows = [{'__parent': in_row, varname:v} for v in out]
         elif isinstance(in_row, Table):
             out = list(out)
@@ -359,6 +811,20 @@ def prep_output(aipl,
             else:
                 raise Exception(f'unknown type for in_row: {type(in_row)}')
 
+            if aipl.streaming and not isinstance(out, (list, tuple)):
+                ret = Table(parent=parent_table)
+                def _rows():
+                    for v in out:
+                        row = {'__parent': parent_row} if parent_row is not None else {}
+                        update_dict(row, v, varname)
+                        ret.add_new_columns(row)
+                        yield row
+
+                ret.stream(_rows())
+                for k in outcols:
+                    ret.add_column(Column(k))
+                return ret
+
             rows = []
             latest_row = {}  # in case there are no rows in out
             all_keys = set()
@@ -402,7 +868,10 @@ def defop(operation:str|Callable|None=None,
           rankin2:None|int|float|str=None,
           outcols:str='',
           preprompt=lambda x: x,
-          opname:str|None=None):
+          opname:str|None=None,
+          io_bound:bool=False,
+          cpu_bound:bool=False,
+          pure:bool=False):
     '''
     Define a new operator.
 
@@ -417,6 +886,19 @@ def defop(operation:str|Callable|None=None,
 
     aipl will be passed to the function if the first argument is called
     'aipl'.
+
+    With io_bound=True, the function must be safe to call from multiple threads;
+    its rows are then evaluated concurrently (see --max-workers and `workers=`).
+    An `async def` function is io_bound, and its rows are run as tasks on one
+    event loop instead (see --max-tasks).
+
+    With cpu_bound=True, scalar inputs are sent to --procs worker processes,
+    which import the function's module (so it must be defined in a module,
+    with picklable inputs and outputs).
+
+    With pure=True, the function has no side effects and returns a result
+    (never None) for every input, so --plan may evaluate it on fewer rows.
+    A pure row operator (rankin=0.5) must only read the columns named in its prompt.
     '''
     # arity implied by rankin
     if rankin is None:
@@ -431,6 +913,9 @@ def defop(operation:str|Callable|None=None,
     rankout = ranktypes.get(rankout, rankout)
     rankin2 = ranktypes.get(rankin2, rankin2)
 
+    if cpu_bound and rankin != 0:
+        raise AIPLException('cpu_bound operators must take scalar input (rankin=0)')
+
     def _decorator(f):
         if opname:
             name = opname
@@ -445,8 +930,11 @@ def defop(operation:str|Callable|None=None,
             rankin2 = rankin2,
             arity = arity,
             outcols = outcols,
-            opname = opname,
+            opname = name,
             preprompt = preprompt,
+            io_bound = io_bound or inspect.iscoroutinefunction(f),
+            cpu_bound = cpu_bound,
+            pure = pure,
             func = f)
         return f
 
@@ -464,6 +952,9 @@ class Operator:
     outcols: str
     opname: str
     preprompt: Callable
+    io_bound: bool
+    cpu_bound: bool
+    pure: bool
     func: Callable
 
     def __call__(self, aipl, *args, **kwargs):
@@ -475,14 +966,28 @@ class Operator:
         return r
 
     @property
+    def is_async(self) -> bool:
+        return inspect.iscoroutinefunction(self.func)
+
+    @property
+    def costly(self) -> bool:
+        'True if worth evaluating on as few rows as possible: @expensive, io_bound, or cpu_bound.'
+        return getattr(self.func, 'expensive', False) or self.io_bound or self.cpu_bound
+
+    @property
+    def rowwise(self) -> bool:
+        'True if each input row gets one output row (if pure).'
+        return self.rankin in (0, 0.5) and self.rankout in (0, 0.5)
+
+    @cached_property
     def needs_prompt(self):
         try:
             return 'prompt' in inspect.signature(self.func).parameters
         except ValueError:
             return False
 
-    @property
-    def _needs_aipl(self):
+    @cached_property
+    def _needs_aipl(self):  # cached: inspect.signature is slower than most operators
         try:
             return list(inspect.signature(self.func).parameters)[0] == 'aipl'
         except ValueError:
@@ -17,7 +17,28 @@ def parse_args(args):
     parser.add_argument('--dry-run', '-n', action='store_true', help='do not execute @expensive operations')
     parser.add_argument('--cache-db', '-c', action='store', default='aipl-cache.sqlite', dest='cachedbfn', help='sqlite database for caching operators')
     parser.add_argument('--no-cache', action='store_const', dest='cachedbfn', const='', help='sqlite database for caching operators')
+    parser.add_argument('--cache-mem-entries', action='store', type=int, default=1000, dest='cache_mem_entries', help='number of recently used cache entries to also keep in memory')
+    parser.add_argument('--cache-mem-bytes', action='store', type=int, default=64*2**20, dest='cache_mem_bytes', help='max bytes of cache entries to keep in memory')
+    parser.add_argument('--cache-backend', action='store', choices=['sqlite', 'lmdb', 'dbm'], default='sqlite', dest='cache_backend', help='where to keep cache entries: tables in the cache db, or a key-value store next to it (lmdb needs the lmdb package; dbm is for a single process only)')
+    parser.add_argument('--cache-codec', action='store', choices=['none', 'zlib', 'zstd'], default='zlib', dest='cache_codec', help='compress new cache entries with this codec (zstd needs the zstandard package)')
+    parser.add_argument('--cache-compress-bytes', action='store', type=int, default=1024, dest='cache_compress_bytes', help='compress cached values larger than this')
+    parser.add_argument('--cache-blob-bytes', action='store', type=int, default=64*1024, dest='cache_blob_bytes', help='store cached values larger than this in files next to the cache db, once per distinct content (0 to keep all in the db)')
+    parser.add_argument('--cache-ttl', action='store', default='', dest='cache_ttl', help='max age of cache entries, in seconds or with suffix s/m/h/d (also !option cache_ttl_<func>=)')
+    parser.add_argument('--cache-gc', action='store_true', dest='cache_gc', help='delete expired cache entries, evict down to --cache-max-bytes, rebuild indexes and VACUUM the cache db; then exit')
+    parser.add_argument('--cache-max-bytes', action='store', type=int, default=0, dest='cache_max_bytes', help='with --cache-gc, max total bytes of cache entries to keep')
+    parser.add_argument('--cache-evict', action='store', choices=['lru', 'lfu'], default='lru', dest='cache_evict', help='with --cache-gc, evict least recently (lru) or least often (lfu) used entries first')
+    parser.add_argument('--memoize', action='store', choices=['off', 'mem', 'db'], default='db', dest='memoize', help='reuse results of @memoize operators like !extract-text and !json-parse for the same input: not at all, within this run, or also across runs in the cache db')
     parser.add_argument('--output-db', '-o', action='store', default='aipl-cache.sqlite', dest='outdbfn', help='sqlite database accessible to !db operators')
+    parser.add_argument('--max-workers', '-j', action='store', type=int, default=8, dest='max_workers', help='max concurrent rows for io-bound operators like !fetch-url')
+    parser.add_argument('--max-tasks', action='store', type=int, default=64, dest='max_tasks', help='max concurrent requests for async operators like !llm')
+    parser.add_argument('--procs', '-P', action='store', type=int, default=1, dest='procs', help='number of worker processes for cpu-bound operators like !extract-text and !pdf-extract')
+    parser.add_argument('--rpm', action='store', type=float, default=0, help='max requests per minute to each LLM model (also !option rpm= or rpm_<model>=)')
+    parser.add_argument('--tpm', action='store', type=float, default=0, help='max tokens per minute to each LLM model (also !option tpm= or tpm_<model>=)')
+    parser.add_argument('--llm-semantic', action='store', type=float, default=0, metavar='THRESHOLD', dest='llm_semantic', help='reuse the !llm answer to a cached prompt with at least this cosine similarity (e.g. 0.95; also !option llm_semantic=)')
+    parser.add_argument('--stream', action='store_true', help='pull rows through commands as needed, instead of finishing each command before the next')
+    parser.add_argument('--plan', '-O', action='store_true', help='move !take and !filter ahead of costly commands like !llm and !fetch-url, when that gives the same result')
+    parser.add_argument('--explain', action='store_true', help='print the plan of commands before running them')
+    parser.add_argument('--pipeline', action='store', type=int, default=0, metavar='N', help='run each command in its own thread, with at most N rows queued for the next command (implies --stream)')
     parser.add_argument('--split', '--separator', '-s', action='store', default='\n', dest='separator', help='separator to split input on')
     parser.add_argument('script_or_global', nargs='*', help='scripts to run, or k=v global parameters')
     return parser.parse_args(args)
@@ -43,6 +64,15 @@ def main():
 
     aipl = AIPL(**vars(args))
 
+    if args.cache_gc:
+        from .caching import cache_gc
+        if not aipl.cache_db:
+            print('no cache db', file=sys.stderr)
+            sys.exit(1)
+        stats = cache_gc(aipl, args.cache_max_bytes, args.cache_evict)
+        print(f'{stats.expired} expired and {stats.evicted} evicted cache entries deleted; {stats.bytes_before} -> {stats.bytes_after} bytes', file=sys.stderr)
+        return
+
     # dup stdin/stdout if necessary
 
     if not sys.stdin.isatty():
@@ -95,5 +125,10 @@ def main():
         print(e, file=sys.stderr)
         sys.exit(1)
     finally:
+        aipl.flush()
+        if aipl.single_flight.deduped:
+            print(f'{aipl.single_flight.deduped} duplicate calls used the result of an identical call in progress', file=sys.stderr)
+        if aipl.cache_stats:
+            print(aipl.cache_stats.summary(), file=sys.stderr)
         if aipl.cost_usd:
             print(f'total cost: ${aipl.cost_usd:.02f}', file=sys.stderr)
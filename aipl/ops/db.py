@@ -16,10 +16,10 @@ def op_dbquery(aipl, row:'LazyRow', dbname:str, tblname:str, *colnames, **kwargs
 @defop('dbdrop', None, None)
 def op_dbdrop(aipl, tblname:str):
     'Drop database table.'
-    aipl.output_db.sql(f'DROP TABLE IF EXISTS {tblname}')
+    aipl.output_db.drop(tblname)
 
 
 @defop('dbinsert', 0.5, None)
 def op_dbinsert(aipl, row, tblname:str, **kwargs):
     'Insert each row into database table.'
-    aipl.output_db.insert(tblname, **row._asdict(), **kwargs)
+    aipl.output_db.buffer(tblname, **row._asdict(), **kwargs)  # inserted together, at the end of the command
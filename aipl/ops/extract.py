@@ -1,10 +1,11 @@
 from typing import List
 from urllib.parse import urljoin
 
-from aipl import defop
+from aipl import defop, memoize
 
 
-@defop('extract-text-all', 0, 0)
+@defop('extract-text-all', 0, 0, cpu_bound=True, pure=True)
+@memoize
 def op_extract_text_all(aipl, html:str, **kwargs) -> str:
     'Extract all text from HTML'
     from bs4 import BeautifulSoup
@@ -12,7 +13,8 @@ def op_extract_text_all(aipl, html:str, **kwargs) -> str:
     return soup.get_text()
 
 
-@defop('extract-text', 0, 0)
+@defop('extract-text', 0, 0, cpu_bound=True, pure=True)
+@memoize
 def op_extract_text(aipl, html:str, **kwargs) -> str:
     'Extract meaningful text from HTML'
     parms = dict(include_comments=False,
@@ -5,7 +5,7 @@ and !json_parse which converts json blob into row.
 
 import json
 
-from aipl import defop, Table, Column
+from aipl import defop, memoize, Table, Column
 
 
 class _jsonEncoder(json.JSONEncoder):
@@ -77,6 +77,7 @@ def pyobj_to_table(r) -> Table|dict|int|float|str:
 
 
 @defop('json-parse', 0, 1.5)
+@memoize
 def op_json_parse(aipl, v:str, **kwargs) -> Table:
     'Convert a json blob into a Table.'
     r = json.loads(v)
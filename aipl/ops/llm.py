@@ -2,14 +2,31 @@
 !llm and !llm-embedding use the OpenAI API to make queries to GPT.
 
 Requires OPENAI_API_KEY and OPENAI_API_ORG envvars to be set.
+
+!llm is async: all its rows are sent as concurrent requests on one event loop, at most --max-tasks (or `workers=`) at a time.
+
+With --llm-semantic THRESHOLD (or `!option llm_semantic=0.95`), a prompt that is not in the cache is embedded
+(with `llm_semantic_model`, default text-embedding-ada-002), and if a prompt answered before with the same
+parameters has a cosine similarity of at least THRESHOLD, its answer is used instead of making a request.
+Answered prompts and their embeddings are kept in the `llm_semantic` table of the cache db, and every lookup
+(prompt, closest prompt, similarity, and whether it was used) is logged to stderr and the `llm_semantic_log` table.
 '''
 
 from typing import List, Dict
 import os
+import time
+import asyncio
+import threading
 import subprocess
+import weakref
 from pathlib import Path
 
-from aipl import defop, expensive, stderr, AIPLException, clients
+from copy import copy
+
+from aipl import defop, expensive, stderr, AIPLException, Error, clients, Table, Column
+from aipl.interpreter import update_dict
+from aipl.caching import cache_key
+from aipl.utils import AttrDict
 
 
 def _parse_msg(s:str):
@@ -27,11 +44,8 @@ def op_llm_mock(aipl, v:str, **kwargs) -> str:
     aipl.cost_usd += cost
     return f'<llm {model} answer>'
 
-@defop('llm', 0, 0)
-@expensive(op_llm_mock)
-def route_llm_query(aipl, v:str, **kwargs) -> str:
-    'Send chat messages to `model` (default: gpt-3.5-turbo).  Lines beginning with @@@s or @@@a are sent as system or assistant messages respectively (default user).  Passes all named args directly to API.'
-    client_str = kwargs.get('client')
+def get_client(client_str:str|None) -> clients.StandardClient:
+    'Return client for `client=` arg to !llm.'
     if client_str is None:
         if 'LLM_CLIENT_ENDPOINT' in os.environ:
             client = clients.SelfHostedChatClient()
@@ -47,35 +61,263 @@ def route_llm_query(aipl, v:str, **kwargs) -> str:
         else:
             raise AIPLException(f"client '{client_str}' not recognized")
 
-    return client.completion(aipl, v, **kwargs)
+    return client
+
+
+@defop('llm', 0, 0, pure=True)
+@expensive(op_llm_mock)
+async def route_llm_query(aipl, v:str, **kwargs) -> str:
+    'Send chat messages to `model` (default: gpt-3.5-turbo).  Lines beginning with @@@s or @@@a are sent as system or assistant messages respectively (default user).  Passes all named args directly to API.'
+    threshold = float(aipl.options.llm_semantic or 0)
+    if threshold and aipl.cache_db:
+        return await semantic_query(aipl, v, threshold, **kwargs)
+
+    client = get_client(kwargs.get('client'))
+    return await client.acompletion(aipl, v, **kwargs)
+
+
+class SemanticIndex:
+    'Prompts answered by !llm with their embeddings, from table llm_semantic in *db*; to find the answer to the most similar prompt.'
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.groups = {}  # cache_key of other !llm params -> AttrDict(prompts=, answers=, vectors=matrix with a unit row vector for each prompt, then spare rows)
+
+    def _group(self, params:str) -> AttrDict:
+        import numpy as np
+        if params not in self.groups:
+            rows = self.db.select('llm_semantic', params=params)
+            self.groups[params] = AttrDict(prompts=[r.prompt for r in rows],
+                                           answers=[r.answer for r in rows],
+                                           vectors=np.array([_unit(r.embedding) for r in rows]))
+        return self.groups[params]
+
+    def search(self, params:str, embedding:List[float]) -> tuple:
+        'Return (similarity, prompt, answer) of the prompt most similar to *embedding*, or (0, None, None) if none.'
+        with self.lock:
+            g = self._group(params)
+            if not g.prompts:
+                return 0, None, None
+            scores = g.vectors[:len(g.prompts)] @ _unit(embedding)
+            i = int(scores.argmax())
+            return float(scores[i]), g.prompts[i], g.answers[i]
 
-@defop('llm-embedding', 0, 0.5)
-@expensive()
-def route_llm_embedding_query(aipl, v:str, **kwargs) -> str:
-    'Get a [text embedding](https://platform.openai.com/docs/guides/embeddings/what-are-embeddings) for a string from `model`: a measure of text-relatedness, to be used with e.g. !cluster.'
+    def add(self, params:str, prompt:str, embedding:List[float], answer:str):
+        import numpy as np
+        with self.lock:
+            g = self._group(params)
+            n = len(g.prompts)
+            if n >= len(g.vectors):  # double the spare rows, so adding n prompts copies O(n) rows in all
+                vectors = np.empty((max(2*n, 16), len(embedding)))
+                if n:
+                    vectors[:n] = g.vectors[:n]
+                g.vectors = vectors
+            g.vectors[n] = _unit(embedding)
+            g.prompts.append(prompt)
+            g.answers.append(answer)
+            self.db.insert('llm_semantic', params=params, prompt=prompt, answer=answer, embedding=list(embedding))
+
+
+def _unit(v:List[float]):
+    import numpy as np
+    v = np.asarray(v, dtype=float)
+    n = np.linalg.norm(v)
+    return v/n if n else v
+
+
+_semantic_indexes = weakref.WeakKeyDictionary()  # aipl.cache_db -> SemanticIndex
+
+def _embedding_cost(aipl, v:str, model:str) -> tuple:
+    'Return (embedding of *v*, its cost in USD), for a thread whose aipl.cost_usd does not reach the caller.'
+    cost_usd = aipl.cost_usd
+    [r] = route_llm_embedding_query(aipl, [v], model=model)
+    return r['embedding'], aipl.cost_usd - cost_usd
+
+async def semantic_query(aipl, v:str, threshold:float, **kwargs) -> str:
+    'Return answer to the most similar prompt answered before with the same *kwargs*, if its similarity to *v* is at least *threshold*; otherwise ask `model` and remember the answer.'
+    model = aipl.options.llm_semantic_model or 'text-embedding-ada-002'
+    embedding, cost_usd = await asyncio.to_thread(_embedding_cost, aipl, v, model)
+    aipl.cost_usd += cost_usd  # to_thread ran it in a copy of this context
+
+    index = _semantic_indexes.setdefault(aipl.cache_db, SemanticIndex(aipl.cache_db))
+    params = cache_key(**kwargs)
+    score, prompt, answer = index.search(params, embedding)
+    hit = score >= threshold
+    aipl.cache_db.insert('llm_semantic_log', time=time.time(), params=params, prompt=v, matched_prompt=prompt, score=score, hit=int(hit))
+    stderr(f'[semantic cache {"hit" if hit else "miss"} {score:.3f}] {v[:40]!r} ~ {(prompt or "")[:40]!r}')
+    if hit:
+        return answer
+
+    client = get_client(kwargs.get('client'))
+    answer = await client.acompletion(aipl, v, **kwargs)
+    index.add(params, v, embedding, answer)
+    return answer
+
+# openai limits embedding requests to 2048 inputs, and this many tokens in total
+EMBEDDING_BATCH_TOKENS = 250000
+
+@defop('llm-embedding', 1.5, 1.5, io_bound=True)
+def op_llm_embedding(aipl, t:Table, batch_size:int=100, **kwargs) -> Table:
+    'Add `model`, `used_tokens`, and `embedding` columns with a [text embedding](https://platform.openai.com/docs/guides/embeddings/what-are-embeddings) of each row from `model`: a measure of text-relatedness, to be used with e.g. !cluster.  Rows are sent `batch_size` at a time.'
+    results = route_llm_embedding_query(aipl, t.values, batch_size=batch_size, **kwargs)
+    ret = copy(t)
+    for row, r in zip(t, results):
+        ret.rows.append(update_dict(row._row, r, 'embedding'))  # an Error for a row without content
+
+    for k in ['model', 'used_tokens', 'embedding']:
+        ret.add_column(Column(k))
+    return ret
+
+def op_llm_embedding_mock(aipl, v:str, **kwargs) -> dict:
+    model = kwargs.get('model')
+    used = clients.count_tokens(v, model=model)
+    aipl.cost_usd += clients.openai_pricing.get(model, 0)*used/1000
+    return dict(model=model, used_tokens=used, embedding=[0.0])
+
+@expensive(op_llm_embedding_mock, batch=True)
+def route_llm_embedding_query(aipl, values:List[str], **kwargs) -> List[dict]:
+    'Get a text embedding for each of the strings in *values* from `model`.'
     model = kwargs.get('model')
     if model in clients.gooseai_models:
         raise AIPLException("GooseAI embeddings not yet supported")
     elif model in clients.openai_pricing:
-        return embedding_openai(aipl, v, **kwargs)
+        return embedding_openai(aipl, values, **kwargs)
     else:
         raise AIPLException(f"{model} not found!")
 
-def embedding_openai(aipl, v:str, **kwargs) -> dict:
-    'Get a an openai [text embedding](https://platform.openai.com/docs/guides/embeddings/what-are-embeddings) for a string: a measure of text-relatedness, to be used with e.g. !cluster.'
+def _token_batches(values:List[str], ntokens:List[int], maxtokens:int):
+    'Yield (values, ntokens) sublists of at most *maxtokens* tokens in total.'
+    i = 0
+    while i < len(values):
+        j = i+1
+        tot = ntokens[i]
+        while j < len(values) and tot+ntokens[j] <= maxtokens:
+            tot += ntokens[j]
+            j += 1
+        yield values[i:j], ntokens[i:j]
+        i = j
+
+def embedding_openai(aipl, values:List[str], **kwargs) -> List[dict]:
+    'Get openai [text embeddings](https://platform.openai.com/docs/guides/embeddings/what-are-embeddings) for a list of strings, in as few requests as possible.  Total used_tokens for each request is apportioned among its inputs by their estimated token counts.  Empty strings and Errors get an Error instead.'
     import openai
 
-    if not v:
-        raise Exception('no content for embedding')
+    ret = []  # None for values to send
+    for v in values:
+        if isinstance(v, Error):
+            ret.append(v)
+        elif not v:
+            ret.append(Error(opname='llm-embedding', exception=AIPLException('no content for embedding')))
+        else:
+            ret.append(None)
+
+    todo = [i for i, r in enumerate(ret) if r is None]
+    if not todo:
+        return ret
 
     if 'OPENAI_API_KEY' not in os.environ or 'OPENAI_API_ORG' not in os.environ:
         raise AIPLException('''OPENAI_API_KEY and OPENAI_API_ORG envvars must be set for !llm''')
 
-    resp = openai.Embedding.create(input=v, **kwargs)
+    model = kwargs.get('model')
+    limiter = clients.rate_limiter(aipl, model)
+    estimates = [clients.count_tokens(values[i], model=model) for i in todo]
+
+    slots = iter(todo)  # indexes in ret, in order of the embeddings returned
+    for batch, ntokens in _token_batches([values[i] for i in todo], estimates, EMBEDDING_BATCH_TOKENS):
+        if limiter:
+            time.sleep(limiter.reserve(sum(ntokens)))
+
+        resp = openai.Embedding.create(input=batch, **kwargs)
+
+        used = resp['usage']['total_tokens']
+        if limiter:
+            limiter.settle(sum(ntokens), used)
+        cost = clients.openai_pricing[model]*used/1000
+        aipl.cost_usd += cost
+        stderr(f'Used {used} tokens for {len(batch)} embeddings.  Cost: ${cost:.03f}')
+
+        embeddings = sorted(resp['data'], key=lambda d: d['index'])
+        for n, d in zip(_apportion(used, ntokens), embeddings):
+            ret[next(slots)] = dict(model=model,
+                                    used_tokens=n,
+                                    embedding=d['embedding'])
+    return ret
+
+def _apportion(total:int, weights:List[int]) -> List[int]:
+    'Split integer *total* proportionally to *weights*; the parts sum to *total*.'
+    weights = [w or 1 for w in weights]
+    parts = [total*w//sum(weights) for w in weights]
+    parts[-1] += total - sum(parts)
+    return parts
+
+
+def test_llm_embedding_batches(cached_aipl, monkeypatch):
+    calls = []
+    def _create(input, **kwargs):
+        calls.append(list(input))
+        return dict(usage=dict(total_tokens=10*len(input)),
+                    data=[dict(index=i, embedding=[float(len(v))]) for i, v in enumerate(input)])
+
+    monkeypatch.setattr('openai.Embedding.create', _create)
+    monkeypatch.setattr(clients, 'count_tokens', lambda s, model='': len(s))
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setenv('OPENAI_API_ORG', 'org-test')
+
+    aipl = cached_aipl(debug=True, test=True)
+    t = aipl.run_test('!llm-embedding model=text-embedding-ada-002 batch_size=2', 'a', 'bb', 'ccc')
+    assert calls == [['a', 'bb'], ['ccc']]
+    assert t.values == [[1.0], [2.0], [3.0]]
+    assert [r['used_tokens'] for r in t] == [6, 14, 10]
+
+    t = aipl.run_test('!llm-embedding model=text-embedding-ada-002 batch_size=2', 'bb', 'dddd', 'a')
+    assert calls[2:] == [['dddd']]
+    assert t.values == [[2.0], [4.0], [1.0]]
+
+    # an empty row gets an Error, and the others are still sent
+    t = aipl.run_test('!llm-embedding model=text-embedding-ada-002', 'eeeee', '', 'a')
+    assert calls[3:] == [['eeeee']]
+    assert t.values[0] == [5.0] and isinstance(t.values[1], Error) and t.values[2] == [1.0]
+    assert aipl.cache_db.select('cached_route_llm_embedding_query', key=cache_key('eeeee', model='text-embedding-ada-002'))
+    assert not aipl.cache_db.select('cached_route_llm_embedding_query', key=cache_key('', model='text-embedding-ada-002'))
+
+
+def test_llm_semantic(cached_aipl, monkeypatch):
+    import sys
+
+    def _embed(aipl, values, **kwargs):  # letter counts
+        aipl.cost_usd += 0.5
+        return [dict(embedding=[v.count(c) for c in 'abcdefghijklmnopqrstuvwxyz']) for v in values]
+
+    asked = []
+    class _Client:
+        async def acompletion(self, aipl, v, **kwargs):
+            asked.append(v)
+            return f'answer to {v}'
+
+    llm = sys.modules[__name__]
+    monkeypatch.setattr(llm, 'route_llm_embedding_query', _embed)
+    monkeypatch.setattr(llm, 'get_client', lambda s: _Client())
+
+    aipl = cached_aipl(debug=True, test=True)
+    aipl.options.llm_semantic = '0.95'
+    t = aipl.run_test('!llm model=m workers=1', 'what is the date', 'What is the date?', 'something else', 'what is the date')
+    assert t.values == ['answer to what is the date']*2 + ['answer to something else', 'answer to what is the date']
+    assert asked == ['what is the date', 'something else']
+
+    log = aipl.cache_db.table('llm_semantic_log')
+    assert [r.hit for r in log] == [0, 1, 0]  # the last prompt was an exact cache hit
+    assert log[1].matched_prompt == 'what is the date' and log[1].score > 0.95
+    assert [r._cost_usd for r in aipl.cache_db.table('cached_route_llm_query')] == [0.5]*3  # embedding cost counted even on a semantic hit
+
+    aipl.run_test('!llm model=other', 'What is the date?')
+    assert asked[-1] == 'What is the date?'  # only reuses answers given with the same parameters
+
 
-    used = resp['usage']['total_tokens']
-    stderr(f'Used {used} tokens')
+def test_semantic_index_grows(cached_aipl):
+    index = SemanticIndex(cached_aipl().cache_db)
+    for i in range(40):
+        index.add('p', f'prompt {i}', [float(i == j) for j in range(40)], f'answer {i}')
+    assert len(index.groups['p'].vectors) == 64
+    assert index.search('p', [float(j == 33) for j in range(40)]) == (1.0, 'prompt 33', 'answer 33')
 
-    return dict(model=kwargs.get('model'),
-                used_tokens=used,
-                embedding=resp['data'][0]['embedding'])
\ No newline at end of file
+    index = SemanticIndex(index.db)  # loaded back from the db
+    assert index.search('p', [float(j == 39) for j in range(40)]) == (1.0, 'prompt 39', 'answer 39')
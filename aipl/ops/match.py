@@ -1,6 +1,6 @@
 from aipl import defop
 
-@defop('match', 0, 0)
+@defop('match', 0, 0, pure=True)
 def op_match(aipl, v:str, regex:str) -> bool:
     'Return a bool with whether value matched regex. Used with !filter.'
     import re
@@ -10,7 +10,7 @@ def _is_int(val):
         return False
 
 def _to_np_int_array(t:Table, colname:str) -> np.array:
-    column = [int(row[colname]) if _is_int(row[colname]) else np.nan for row in t]
+    column = [int(v) if _is_int(v) else np.nan for v in t.vector(colname)]
     return np.array(column)
 
 def _true_positives(predictions:np.array, true_values:np.array) -> float:
@@ -1,7 +1,8 @@
-from aipl import defop
+from aipl import defop, memoize
 
 
-@defop('pdf-extract', 0, 0)
+@defop('pdf-extract', 0, 0, cpu_bound=True, pure=True)
+@memoize
 def op_pdf_extract(aipl, pdfdata:bytes) -> str:
     'Extract contents of pdf to value.'
     from pdfminer.high_level import extract_text
@@ -51,4 +51,4 @@ defop(operator.sub)
 defop(operator.mul)
 defop(operator.truediv)
 defop(len, rankin='vector')
-defop(len, opname='strlen')
+defop(len, opname='strlen', pure=True)
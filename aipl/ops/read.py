@@ -1,25 +1,106 @@
 from urllib.parse import urlparse, urlunparse
+import time
 
 from aipl import defop, dbcache, stderr, alias
+from aipl.caching import parse_duration, MISSING
 
 
-@dbcache
-def _fetch_url_bytes(aipl, url:str) -> bytes:
+_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control', 'Expires')  # kept with cached responses
+
+
+def _freshness(aipl, headers, now:float) -> dict|None:
+    '''Return _HEADERS from response *headers*, and until when the response is fresh (from Cache-Control max-age, or Expires, else option fetch_max_age).
+    None if the response has neither validators nor a lifetime; it is then reused as long as it is cached.'''
+    from email.utils import parsedate_to_datetime
+
+    ret = {k:headers[k] for k in _HEADERS if headers.get(k)}
+    lifetime = None
+    for x in ret.get('Cache-Control', '').lower().split(','):
+        x = x.strip()
+        if x in ('no-cache', 'no-store'):
+            lifetime = 0
+        elif x.startswith('max-age=') and lifetime is None:
+            try:
+                lifetime = max(int(x[8:]), 0)
+            except ValueError:
+                pass
+
+    if lifetime is None and 'Expires' in ret:
+        try:
+            lifetime = max(parsedate_to_datetime(ret['Expires']).timestamp() - now, 0)
+        except (TypeError, ValueError):
+            lifetime = 0  # invalid Expires means already expired
+
+    if lifetime is None:
+        if 'ETag' not in ret and 'Last-Modified' not in ret:
+            return None
+        lifetime = parse_duration(aipl.options.get('fetch_max_age', '1h'))
+
+    ret['fresh_until'] = now + lifetime
+    return ret
+
+
+def _user_agent() -> str:
+    'Return the User-Agent sent by trafilatura, which fetched pages before.'
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return f'trafilatura/{version("trafilatura")} (+https://github.com/adbar/trafilatura)'
+    except PackageNotFoundError:
+        return 'aipl (+https://github.com/saulpw/aipl)'
+
+
+def _fetch(aipl, validators:dict|None, url:str):
+    '''Return (contents of *url*, validators from _freshness), or (MISSING, validators) if the cached contents with *validators* are still current.
+    Once stale, ask the server again with If-None-Match/If-Modified-Since; a 304 Not Modified renews the cached contents without downloading them.'''
     import urllib.request
-    stderr(f'fetching {url}...')
-    with urllib.request.urlopen(url) as resp:
-        return resp.read()
+    import urllib.error
+
+    if validators and time.time() < validators['fresh_until']:
+        return MISSING, validators
+
+    req = urllib.request.Request(url, headers={'User-Agent': aipl.options.get('fetch_user_agent') or _user_agent()})
+    if validators:
+        if 'ETag' in validators:
+            req.add_header('If-None-Match', validators['ETag'])
+        if 'Last-Modified' in validators:
+            req.add_header('If-Modified-Since', validators['Last-Modified'])
+        stderr(f'revalidating {url}...')
+    else:
+        stderr(f'fetching {url}...')
+
+    try:
+        with urllib.request.urlopen(req, timeout=parse_duration(aipl.options.get('fetch_timeout', 30))) as resp:
+            return resp.read(), _freshness(aipl, resp.headers, time.time())
+    except urllib.error.HTTPError as e:
+        if e.code != 304 or not validators:
+            raise
+        # not modified: keep the cached contents, with headers updated by those sent with the 304
+        return MISSING, _freshness(aipl, dict(validators, **{k:e.headers[k] for k in _HEADERS if e.headers.get(k)}), time.time())
+
 
+@dbcache(revalidate=_fetch)
+def _fetch_url_bytes(aipl, url:str):
+    return _fetch(aipl, None, url)
 
-@dbcache
-def _fetch_url(aipl, url:str) -> str:
-    import trafilatura
-    stderr(f'fetching {url}...')
+
+def _decode(data:bytes) -> str:
+    from trafilatura.utils import decode_file
     # guess at decoding and other helpful things
-    return trafilatura.fetch_url(url)
+    return decode_file(data)
+
+
+def _fetch_text(aipl, validators:dict|None, url:str):
+    'Return _fetch(...), with contents decoded to str.'
+    data, validators = _fetch(aipl, validators, url)
+    return (data if data is MISSING else _decode(data)), validators
+
 
+@dbcache(revalidate=_fetch_text)
+def _fetch_url(aipl, url:str):
+    return _fetch_text(aipl, None, url)
 
-@defop('read', 0, 0)
+
+@defop('read', 0, 0, io_bound=True, pure=True)
 def op_read(aipl, url:str) -> str:
     'Return contents of local filename.'
     if '://' in url:
@@ -29,13 +110,69 @@ def op_read(aipl, url:str) -> str:
     return open(url).read()
 
 
-@defop('read-bytes', 0, 0)
+@defop('read-bytes', 0, 0, io_bound=True, pure=True)
 def op_read_bytes(aipl, url:str) -> bytes:
     'Return contents of URL or local filename as bytes.'
     if '://' in url:
         url = urlunparse(urlparse(url)._replace(fragment=''))
-        return _fetch_url_bytes(url)
+        return _fetch_url_bytes(aipl, url)
 
     return open(url, mode='rb').read()
 
 alias('fetch-url', 'read')
+
+
+def test_fetch_revalidate(cached_aipl):
+    import threading
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+    pages = {'/etag': ('"v1"', 'max-age=0'), '/fresh': ('"f1"', 'max-age=3600'), '/plain': (None, None)}
+    requests = []
+    agents = set()
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            etag, cachecontrol = pages[self.path]
+            requests.append((self.path, self.headers.get('If-None-Match')))
+            agents.add(self.headers.get('User-Agent'))
+            if etag and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            body = f'{self.path} {etag}'.encode()
+            self.send_response(200)
+            if etag:
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', cachecontrol)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+    aipl = cached_aipl(debug=True, test=True)
+    try:
+        for i in range(2):
+            assert _fetch_url_bytes(aipl, url+'/etag') == b'/etag "v1"'
+            assert _fetch_url_bytes(aipl, url+'/fresh') == b'/fresh "f1"'
+            assert _fetch_url_bytes(aipl, url+'/plain') == b'/plain None'
+            aipl.cache_mem.clear()
+
+        # stale /etag is revalidated and not downloaded again; fresh /fresh and /plain (without validators) are not requested
+        assert requests == [('/etag', None), ('/fresh', None), ('/plain', None), ('/etag', '"v1"')]
+        c = aipl.cache_stats.tables['cached__fetch_url_bytes']
+        assert (c.hits, c.misses) == (3, 3)
+
+        pages['/etag'] = ('"v2"', 'max-age=0')
+        assert _fetch_url_bytes(aipl, url+'/etag') == b'/etag "v2"'
+        assert requests[-1] == ('/etag', '"v1"')
+        assert (c.hits, c.misses) == (3, 4)
+        assert agents == {_user_agent()}
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -25,7 +25,7 @@ def preprompt_translate(prompt:str=''):
 
     return d
 
-@defop('regex-translate', 0, 0, preprompt=preprompt_translate)
+@defop('regex-translate', 0, 0, preprompt=preprompt_translate, pure=True)
 def regex_translate(aipl, v:str, prompt:list):
     r'''Translate input according to regex translation rules in prompt, one per line, with regex and output separated by whitespace:
         \bDr\.?\b Doctor
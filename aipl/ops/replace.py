@@ -1,6 +1,6 @@
 from aipl import defop
 
-@defop('replace', 0, 0)
+@defop('replace', 0, 0, pure=True)
 def op_replace(aipl, s:str, find:str, repl:str) -> str:
     'Replace `find` in all leaf values with `repl`.'
     return s.replace(find, repl)
@@ -1,4 +1,6 @@
-from aipl import defop, Table, alias
+from array import array
+
+from aipl import defop, Table, ColumnarTable, alias
 
 
 @defop('table', 100, 1.5)
@@ -9,3 +11,25 @@ def op_table(aipl, t:Table, tname:str) -> Table:
 
 
 alias('global', 'table')
+
+
+@defop('columnar', 1.5, 1.5)
+def op_columnar(aipl, t:Table) -> Table:
+    'Store table by column instead of by row, with numeric columns in arrays; for large tables of numbers or short strings.'
+    return ColumnarTable.from_table(t).compact()
+
+
+def test_columnar(aipl):
+    t = aipl.run_test('!split>w !columnar !format\n<{w}>\n!join', 'a b c')
+    assert t.values == ['<a> <b> <c>']
+
+    t = ColumnarTable([dict(n=3, s='x'), dict(n=1), dict(n=2, s='z')]).compact()
+    assert isinstance(t.vectors['n'], array)
+    assert t.vector('n') is t.vectors['n']
+    assert t.values == ['x', None, 'z']
+    t[1]._row['n'] = 'one'  # doesn't fit in the array
+    assert t.vector('n') == [3, 'one', 2]
+    assert [dict(r._row) for r in t] == [dict(n=3, s='x'), dict(n='one'), dict(n=2, s='z')]
+
+    t = aipl.run_test('!split>n !columnar !metrics-recall n n', '1 0 1')
+    assert t.values == [1.0]
@@ -3,6 +3,7 @@
 '''
 
 from copy import copy
+from itertools import islice
 
 from aipl import defop
 from aipl.table import Table
@@ -11,7 +12,7 @@ from aipl.table import Table
 def op_take(aipl, t:Table, n=1) -> Table:
     'Return a table with first n rows of `t`'
     ret = copy(t)
-    ret.rows = t.rows[:n]
+    ret.rows = [r._row for r in islice(t, int(n))]  # with --stream, stops pulling rows from upstream after n
     return ret
 
 
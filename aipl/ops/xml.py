@@ -1,5 +1,5 @@
 from typing import List
-from aipl import defop
+from aipl import defop, memoize
 
 def _xml(s):
     if not isinstance(s, str):
@@ -42,6 +42,7 @@ def StringifiableObject(s):
 
 
 @defop('xml-xpath', 0, 1)
+@memoize
 def op_xml_xpath(aipl, v:str, *args) -> List['XmlElement']:
     "Return a vector of XMLElements from parsing entries in value."
     xml = _xml(v)
@@ -51,6 +52,7 @@ def op_xml_xpath(aipl, v:str, *args) -> List['XmlElement']:
 
 
 @defop('xml-xpaths', 0, 0.5)
+@memoize
 def op_xml_xpaths(aipl, v:str, **kwargs) -> List['XmlElement']:
     "Return a vector of XMLElements from parsing entries in value; kwargs become column_name=xpath."
     xml = _xml(v)
@@ -0,0 +1,150 @@
+'''
+Optional planning pass (--plan) over the parsed Command list, run before any of it is evaluated.
+
+Commands that only drop rows (`!take`, and `!filter` with its predicate) are moved ahead of costly commands
+(@expensive, io_bound, or cpu_bound), so those are evaluated on fewer rows.
+A command is only moved past commands whose operator is declared `pure` and rowwise (one output row for each input row),
+and only if it does not read any column they write.
+
+`!columns` is never moved: the rows it makes still reach their parent rows, so the "dropped" columns remain readable by later commands,
+and the column it leaves current is different.
+'''
+
+from typing import List
+from string import Formatter
+
+from .parser import Command
+from .table import CURRENT_COLNAME
+
+
+def _fields(s) -> set:
+    'Return names of format fields in string *s*.'
+    if not isinstance(s, str):
+        return set()
+    try:
+        return {name.split('.')[0].split('[')[0] for _, name, _, _ in Formatter().parse(s) if name}
+    except ValueError:
+        return {CURRENT_COLNAME}  # unparseable: assume the worst
+
+
+def reads(cmd:Command) -> set:
+    'Return names of columns that *cmd* reads from its input rows.  CURRENT_COLNAME means the current (last) column.'
+    r = set()
+    for arg in cmd.args:
+        r |= _fields(arg)
+    for v in cmd.kwargs.values():
+        r |= _fields(v)
+    r |= set(cmd.input_cols)
+
+    if cmd.op.rankin == 0 and not cmd.input_cols:
+        r.add(CURRENT_COLNAME)
+    elif cmd.op.rankin == 0.5:
+        if cmd.op.pure and cmd.prompt is not None:
+            r |= _fields(cmd.prompt)  # a pure row operator only reads the columns named in its prompt template
+        else:
+            r.add(CURRENT_COLNAME)
+    return r
+
+
+def writes(cmd:Command) -> set|None:
+    'Return names of columns that rowwise *cmd* adds to its input rows, or None if unknown.'
+    if cmd.op.rankout == 0.5 and not cmd.op.outcols:
+        return None  # keys of output dict
+    r = set(cmd.op.outcols.split())
+    if cmd.varnames:
+        r.add(cmd.varnames[-1])
+    return r
+
+
+def _plain(cmd:Command) -> bool:
+    'True if *cmd* does not touch anything beyond the rows of its one input table.'
+    return not (cmd.globals or cmd.input_tables or cmd.input_cols)
+
+
+def _can_pass(group:List[Command], cmd:Command) -> bool:
+    'Return True if *group* gives the same result if moved from just after *cmd* to just before it.'
+    if not (cmd.op.pure and cmd.op.rowwise and _plain(cmd)):
+        return False
+    written = writes(cmd)
+    if written is None:
+        return False
+    needed = set().union(*(reads(c) for c in group))
+    return not (needed & (written | {CURRENT_COLNAME}))
+
+
+def _row_dropping_group(cmds:List[Command], i:int) -> int|None:
+    'If cmds[i] only drops rows, return index of the first command of its group (with its predicate), otherwise None.'
+    cmd = cmds[i]
+    if cmd.op.opname == 'take':
+        if _plain(cmd) and not cmd.varnames and cmd.prompt is None:
+            return i
+    elif cmd.op.opname == 'filter' and i > 0:
+        # the predicate adds one column, which !filter then removes; leaving the current column as it was
+        pred = cmds[i-1]
+        if pred.op.pure and pred.op.rowwise and pred.op.rankout == 0 and _plain(pred) and not cmd.varnames:
+            return i-1
+
+
+def plan(cmds:List[Command]) -> List[Command]:
+    'Return new list of commands, with row-dropping commands moved ahead of the costly commands they can pass.'
+    cmds = list(cmds)
+    i = 0
+    while i < len(cmds):
+        j = _row_dropping_group(cmds, i)
+        if j is None:
+            i += 1
+            continue
+
+        group = cmds[j:i+1]
+        k = j
+        while k > 0 and _can_pass(group, cmds[k-1]):
+            k -= 1
+
+        passed = cmds[k:j]
+        if any(c.op.costly for c in passed):
+            cmds[k:i+1] = group + passed
+        i += 1
+
+    return cmds
+
+
+def fmtcmd(cmd:Command) -> str:
+    'Return source-like text of *cmd* (without its prompt).'
+    r = '!' + cmd.opname
+    r += ''.join('>'+v for v in cmd.varnames)
+    r += ''.join('>>'+v for v in cmd.globals)
+    r += ''.join(f' {arg}' for arg in cmd.args)
+    r += ''.join(f' {k}={v}' for k, v in cmd.kwargs.items())
+    r += ''.join(' <'+c for c in cmd.input_cols)
+    r += ''.join(' <<'+t for t in cmd.input_tables)
+    return r
+
+
+def annotate(original:List[Command], planned:List[Command], fusable=None) -> List[tuple]:
+    '''Return [(cmd, [notes]), ...] for each command of *planned*: which commands of *original* it was moved ahead of,
+    whether it is evaluated in the same pass over the rows as the command before it (per *fusable*, like AIPL.fusable), and whether its rows run concurrently.'''
+    pos = {id(c):n for n, c in enumerate(planned)}
+    ret = []
+    for j, cmd in enumerate(planned):
+        notes = []
+        i = next(n for n, c in enumerate(original) if c is cmd)
+        passed = [c for c in original[:i] if pos[id(c)] > pos[id(cmd)]]
+        if passed:
+            notes.append('moved ahead of ' + ', '.join('!'+c.opname for c in passed))
+        if fusable and j > 0 and fusable(planned[j-1]) and fusable(cmd):
+            notes.append('fused')
+        if cmd.op.io_bound or cmd.op.cpu_bound:
+            notes.append('concurrent')
+        ret.append((cmd, notes))
+    return ret
+
+
+def explain(original:List[Command], planned:List[Command], fusable=None) -> str:
+    'Return description of *planned*, with the notes from annotate().'
+    lines = ['plan:']
+    for cmd, notes in annotate(original, planned, fusable):
+        line = f'  [line {cmd.linenum-1:>3}] {fmtcmd(cmd)}'
+        if notes:
+            line += '  # ' + '; '.join(notes)
+        lines.append(line)
+    return '\n'.join(lines)
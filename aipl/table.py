@@ -1,5 +1,9 @@
 from typing import Mapping, List
+from collections.abc import MutableMapping
 from copy import copy
+from array import array
+import threading
+from itertools import count
 
 from aipl import AIPLException
 from .utils import fmtargs, fmtkwargs, stderr, strify
@@ -7,15 +11,34 @@ from .utils import fmtargs, fmtkwargs, stderr, strify
 UNWORKING = object()
 CURRENT_COLNAME='_'
 
+# each is changed to the next value from its counter, which is atomic, so changes from concurrent rows are never lost
+_rank_generations = count(1)
+_rank_generation = 0  # changed whenever a table with cached rank changes it, so tables containing it know to compute theirs again
+_shape_generations = count(1)
+_shape_generation = 0  # same for shape, which also changes when rows are added
+_rename_generations = count(1)
+_renames = 0  # changed whenever a Column is renamed, so each Schema knows to index its columns again
+
 class Row(dict):
     pass
 
 
 class Column:
     def __init__(self, key, name=''):
-        self.name = name or key
+        self._name = name or key
         self.key = key
 
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @name.setter
+    def name(self, name:str):
+        global _renames
+        if name != self._name:
+            self._name = name
+            _renames = next(_rename_generations)
+
     @property
     def hidden(self) -> bool:
         return self.name.startswith('_')
@@ -38,8 +61,8 @@ class Column:
         return f"<Column {self.name} {self.key}>"
 
     def deepname(self, table):
-        if table.rows:
-            r = self.get_value(table.rows[0])
+        if table._rows:
+            r = self.get_value(table._rows[0])
             if isinstance(r, Table):
                 return f'{self.name}:{r.deepcolnames}'
 
@@ -56,6 +79,69 @@ class SubColumn(Column):
         return self.origcol.get_value(row[self.key])
 
 
+class Schema(list):
+    'Columns of a table, in order; get() finds the first one with a given name without going through them all.  Calls *on_change*() after each change.'
+    def __init__(self, columns=(), on_change=None):
+        super().__init__(columns)
+        self.on_change = on_change
+        self._byname = None  # name -> Column
+        self._renames = _renames
+
+    def get(self, name:str) -> Column|None:
+        if self._byname is None or self._renames != _renames:
+            byname = {}
+            for c in self:
+                byname.setdefault(c.name, c)
+            self._byname = byname
+            self._renames = _renames
+        return self._byname.get(name)
+
+    def _changed(self):
+        self._byname = None
+        if self.on_change:
+            self.on_change()
+
+    def append(self, col:Column):
+        super().append(col)
+        self._changed()
+
+    def insert(self, i:int, col:Column):
+        super().insert(i, col)
+        self._changed()
+
+    def extend(self, cols):
+        super().extend(cols)
+        self._changed()
+
+    def remove(self, col:Column):
+        super().remove(col)
+        self._changed()
+
+    def pop(self, i:int=-1) -> Column:
+        ret = super().pop(i)
+        self._changed()
+        return ret
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def __setitem__(self, i, v):
+        super().__setitem__(i, v)
+        self._changed()
+
+    def __delitem__(self, i):
+        super().__delitem__(i)
+        self._changed()
+
+    def __iadd__(self, cols):
+        self.extend(cols)
+        return self
+
+    def __reduce__(self):
+        return (Schema, (list(self),))  # on_change is set again by Table.__setstate__
+
+
 class LazyRow(Mapping):
     def __init__(self, table:'Table', row:Row):
         self._row = row
@@ -132,10 +218,70 @@ class LazyRow(Mapping):
         return f"<LazyRow row={self._asdict()} parent={self.parent_row!r}>"
 
 
+class _Rows(list):
+    'Rows of *table*: a list that tells the table when rows are added or replaced, as its rank and shape may then change.'
+    def __init__(self, table:'Table', rows=()):
+        super().__init__(rows)
+        self.table = table
+
+    def append(self, row):
+        super().append(row)
+        self.table._changed(rank=len(self) == 1)
+
+    def extend(self, rows):
+        n = len(self)
+        super().extend(rows)
+        self.table._changed(rank=n == 0)
+
+    def __iadd__(self, rows):
+        self.extend(rows)
+        return self
+
+    def insert(self, i:int, row):
+        super().insert(i, row)
+        self.table._changed()
+
+    def pop(self, i:int=-1):
+        ret = super().pop(i)
+        self.table._changed()
+        return ret
+
+    def remove(self, row):
+        super().remove(row)
+        self.table._changed()
+
+    def clear(self):
+        super().clear()
+        self.table._changed()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.table._changed()
+
+    def reverse(self):
+        super().reverse()
+        self.table._changed()
+
+    def __setitem__(self, i, v):
+        super().__setitem__(i, v)
+        self.table._changed()
+
+    def __delitem__(self, i):
+        super().__delitem__(i)
+        self.table._changed()
+
+    def __reduce__(self):
+        return (list, (list(self),))  # made _Rows again by Table.__setstate__
+
+
 class Table:
     def __init__(self, rows:List[Mapping|LazyRow]=[], parent:'Table|None'=None):
-        self.rows = []  # list of dict
-        self.columns = []  # list of Column
+        self._rankcache = None  # (_rank_generation, first row value, rank)
+        self._shapecache = None  # (_shape_generation, first row value, number of rows, shape)
+        self._rows = _Rows(self)  # list of dict
+        self.source = None  # iterator of further row dicts, pulled only as needed (see stream())
+        self._lock = None  # for source, which may be pulled from several threads with --pipeline
+        self.columns = []  # Schema
         self.parent = parent
         self.scalar = None
 
@@ -145,11 +291,78 @@ class Table:
         else:
             self.scalar = rows
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._columns.on_change = self._changed
+        if type(self._rows) is list:
+            self._rows = _Rows(self, self._rows)
+
+    @property
+    def rows(self) -> List[Row]:
+        'All rows, after pulling any remaining from source.'
+        if self.source is not None:
+            while self._pull():
+                pass
+        return self._rows
+
+    @rows.setter
+    def rows(self, rows:List[Row]):
+        self._rows = _Rows(self, rows)
+        self.source = None
+        self._changed()
+
+    @property
+    def columns(self) -> Schema:
+        return self._columns
+
+    @columns.setter
+    def columns(self, columns:List[Column]):
+        self._columns = Schema(columns, self._changed)
+        self._changed()
+
+    def _changed(self, rank:bool=True):
+        'Forget cached shape (and rank, unless *rank* is False, e.g. when only adding rows after the first); then tables containing this one compute theirs again too.'
+        global _rank_generation, _shape_generation
+        if self._shapecache:
+            self._shapecache = None
+            _shape_generation = next(_shape_generations)
+        if rank and self._rankcache:
+            self._rankcache = None
+            _rank_generation = next(_rank_generations)
+
+    def stream(self, source) -> 'Table':
+        'Get rows from iterator *source* as they are needed, instead of all at once.  Pull the first row right away, so that columns added by source for it are known.'
+        self._lock = threading.Lock()
+        self.source = iter(source)
+        self._pull()
+        return self
+
+    def _pull(self) -> bool:
+        'Move next row from source into rows.  Return False if there are no more.'
+        if self.source is None:
+            return False
+        with self._lock:
+            if self.source is None:  # finished by another thread meanwhile
+                return False
+            try:
+                self._rows.append(next(self.source))
+                return True
+            except StopIteration:
+                self.source = None
+                return False
+
+    def _has_row(self, i:int) -> bool:
+        'Return True if there is a row at index *i*, pulling from source as needed.'
+        while i >= len(self._rows):
+            if not self._pull():
+                return i < len(self._rows)  # may have been pulled by another thread
+        return True
+
     def __len__(self):
         return len(self.rows)
 
     def __bool__(self):
-        return len(self.rows) > 0
+        return self._has_row(0)
 
     def __copy__(self) -> 'Table':
         'Returns structural copy of table with all columns and no rows.'
@@ -164,7 +377,7 @@ class Table:
 
     def axis(self, rank:int=0):
         if self.rank > rank:
-            firstrowval = self.columns[-1].get_value(self.rows[0])
+            firstrowval = self.columns[-1].get_value(self._rows[0])
             return firstrowval.axis(rank)
 
         return self
@@ -179,17 +392,35 @@ class Table:
     def shape(self) -> List[int]:
         if self.scalar is not None:
             return []
-        dims = [len(self.rows)]
-        if self.rows:
-            if self.columns:
-                firstrowval = self.current_col.get_value(self.rows[0])
-                if isinstance(firstrowval, Table):
-                    dims += firstrowval.shape
-        return dims
+        nrows = len(self.rows)
+        firstrowval = self._firstrowval()
+        c = self._shapecache
+        if c and c[0] == _shape_generation and c[1] is firstrowval and c[2] == nrows:
+            return list(c[3])
+
+        dims = [nrows]
+        if isinstance(firstrowval, Table):
+            dims += firstrowval.shape
+        self._shapecache = (_shape_generation, firstrowval, nrows, dims)
+        return list(dims)
 
     @property
     def rank(self) -> int:
-        return len(self.shape)
+        'Same as len(shape), without pulling all rows.'
+        if self.scalar is not None:
+            return 0
+        firstrowval = self._firstrowval()
+        c = self._rankcache
+        if c and c[0] == _rank_generation and c[1] is firstrowval:
+            return c[2]
+
+        r = 1 + firstrowval.rank if isinstance(firstrowval, Table) else 1
+        self._rankcache = (_rank_generation, firstrowval, r)
+        return r
+
+    def _firstrowval(self):
+        if self and self.columns:
+            return self.current_col.get_value(self._rows[0])
 
     @property
     def colnames(self):
@@ -208,9 +439,9 @@ class Table:
         return ','.join(f'{c.deepname(self)}' for c in self.columns if not c.hidden or c is self.current_col) or "no cols"
 
     def __getitem__(self, k:int) -> LazyRow:
-        if k >= len(self.rows):
+        if not self._has_row(k):
             raise IndexError('table index out of range')
-        return LazyRow(self, self.rows[k])
+        return LazyRow(self, self._rows[k])
 
     def _asdict(self):
         if self.scalar is not None:
@@ -221,11 +452,14 @@ class Table:
         if self.scalar is not None:
             return str(self.scalar)
 
-        shapestr = 'x'.join(map(str, self.shape))
+        if self.source is None:
+            shapestr = 'x'.join(map(str, self.shape))
+        else:  # don't pull all rows just to print
+            shapestr = f'{len(self._rows)}+'
         contentstr = ''
-        if self.rows:
+        if self:
             contentstr += strify(self[0], maxlen=20)
-        if len(self.rows) > 1:
+        if len(self._rows) > 1 or self.source is not None:
             contentstr += ' ...'
         return f'<Table [{shapestr} {self.deepcolnames}] {contentstr}>'
 
@@ -233,8 +467,10 @@ class Table:
         if self.scalar is not None:
             yield self.scalar
         else:
-            for r in self.rows:
-                yield LazyRow(self, r)
+            i = 0
+            while self._has_row(i):
+                yield LazyRow(self, self._rows[i])
+                i += 1
 
     def add_new_columns(self, row:Row):
         for k in row.keys():
@@ -243,9 +479,9 @@ class Table:
 
     def add_column(self, col:Column):
         assert not col.name.startswith('__')
-        if self.rows:
-            assert col.get_value(self.rows[0]) is not UNWORKING
-        if col.name in self.colnames:
+        if self._rows:
+            assert col.get_value(self._rows[0]) is not UNWORKING
+        if self.columns.get(col.name) is not None:
             return
 
         if col.name.startswith('_cost'):
@@ -253,15 +489,18 @@ class Table:
         else:
             self.columns.append(col)
 
+    def vector(self, colname:str=CURRENT_COLNAME) -> list:
+        'Return values of column *colname* (or a column of the parent rows), one for each row.'
+        c = self.get_column(colname)
+        if c is None:
+            return [r[colname] for r in self]
+        return [c.get_value(row) for row in self.rows]
+
     def get_column(self, name:str) -> Column:
         if name == CURRENT_COLNAME:
             return self.columns[-1]
 
-        for c in self.columns:
-            if c.name == name:
-                return c
-
-        return None
+        return self.columns.get(name)
 
     def append(self, row:dict):
         if isinstance(row, LazyRow):
@@ -271,3 +510,167 @@ class Table:
             self.add_new_columns(row)
         else:
             raise TypeError(f"row must be Mapping or LazyRow not {type(row)}")
+
+
+class ColumnRow(MutableMapping):
+    'Row *i* of ColumnarTable *table*: its value in each of table.vectors, if not None.'
+    __slots__ = ('_table', '_i')
+
+    def __init__(self, table:'ColumnarTable', i:int):
+        self._table = table
+        self._i = i
+
+    def get(self, k, default=None):
+        vec = self._table.vectors.get(k)
+        if vec is None:
+            return default
+        v = vec[self._i]
+        if v is None:
+            return default
+        if hasattr(v, 'dtype'):  # numpy scalar
+            return v.item()
+        return v
+
+    def __getitem__(self, k):
+        v = self.get(k, UNWORKING)
+        if v is UNWORKING:
+            raise KeyError(k)
+        return v
+
+    def __setitem__(self, k, v):
+        self._table._set(k, self._i, v)
+
+    def __delitem__(self, k):
+        if self.get(k) is None:
+            raise KeyError(k)
+        self._table._set(k, self._i, None)
+
+    def __iter__(self):
+        return (k for k, vec in list(self._table.vectors.items()) if vec[self._i] is not None)
+
+    def __len__(self):
+        return sum(1 for k in self)
+
+    def __repr__(self):
+        return f'<ColumnRow {self._i} {dict(self)}>'
+
+
+class _ColumnRows:
+    'The rows of ColumnarTable *table*, as ColumnRow views; quacks like the list of dicts in Table._rows.'
+    def __init__(self, table:'ColumnarTable'):
+        self.table = table
+
+    def __len__(self):
+        return self.table._nrows
+
+    def __getitem__(self, i:int|slice):
+        n = self.table._nrows
+        if isinstance(i, slice):
+            return [ColumnRow(self.table, j) for j in range(*i.indices(n))]
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('table index out of range')
+        return ColumnRow(self.table, i)
+
+    def __iter__(self):
+        for i in range(self.table._nrows):
+            yield ColumnRow(self.table, i)
+
+    def append(self, row:Mapping):
+        self.table._append(row)
+
+
+class ColumnarTable(Table):
+    '''Table with its values kept by column instead of by row: vectors[key] has a value for each row (None if the row has no value for key).
+    A vector is a list, or an array.array or numpy array of numbers (see compact); one is turned into a list if given a value that doesn't fit.
+    Rows are ColumnRow views, so it can be used like any other Table; operators that scan whole columns can use vector() to get at the vectors themselves.'''
+    def __init__(self, rows:List[Mapping|LazyRow]=[], parent:'Table|None'=None, vectors:Mapping=None):
+        self.vectors = {}  # key -> list or array of values
+        self._nrows = 0
+        super().__init__(rows, parent)
+        if vectors:
+            self._nrows = len(next(iter(vectors.values())))
+            assert all(len(vec) == self._nrows for vec in vectors.values()), 'vectors must all be the same length'
+            self.vectors = dict(vectors)
+            self.add_new_columns(self.vectors)
+
+    @classmethod
+    def from_table(cls, t:Table) -> 'ColumnarTable':
+        'Return ColumnarTable with the same columns and rows as *t*.'
+        ret = cls(parent=t.parent)
+        for c in t.columns:
+            ret.add_column(copy(c))
+        ret.rows = t.rows
+        ret.scalar = t.scalar
+        return ret
+
+    @property
+    def _rows(self) -> _ColumnRows:
+        return _ColumnRows(self)
+
+    @_rows.setter
+    def _rows(self, rows:List[Mapping]):
+        rows = [dict(r) if isinstance(r, ColumnRow) else r for r in rows]  # might be views of these vectors
+        self.vectors = {}
+        self._nrows = 0
+        for row in rows:
+            self._append(row)
+
+    def _append(self, row:Mapping):
+        if isinstance(row, LazyRow):
+            row = row._row
+        i = self._nrows
+        for k in row.keys():
+            if k not in self.vectors:
+                self.vectors[k] = [None]*i
+        for k in list(self.vectors.keys()):
+            self._set(k, i, row.get(k))
+        self._nrows = i+1
+        self._changed(rank=i == 0)
+
+    def _set(self, k, i:int, v):
+        if i == 0:
+            self._changed()
+        vec = self.vectors.get(k)
+        if vec is None:
+            if v is None:
+                return
+            vec = self.vectors[k] = [None]*self._nrows
+
+        try:
+            if i == len(vec):
+                vec.append(v)
+            else:
+                vec[i] = v
+            return
+        except (TypeError, ValueError, OverflowError, AttributeError):  # doesn't fit in array, or numpy array (which can't append)
+            vec = self.vectors[k] = vec.tolist() if hasattr(vec, 'tolist') else list(vec)
+
+        if i == len(vec):
+            vec.append(v)
+        else:
+            vec[i] = v
+
+    def vector(self, colname:str=CURRENT_COLNAME):
+        'Return vector of values of column *colname* itself (not a copy), if it is a plain column.'
+        c = self.get_column(colname)
+        if type(c) is Column and isinstance(c.key, str):
+            self.rows  # pull all from source
+            vec = self.vectors.get(c.key)
+            return [None]*self._nrows if vec is None else vec
+        return super().vector(colname)
+
+    def compact(self) -> 'ColumnarTable':
+        'Store vectors of only ints (or only floats) in an array.array, which takes 8 bytes per value instead of a Python object each.'
+        for k, vec in self.vectors.items():
+            if not isinstance(vec, list) or not vec:
+                continue
+            if all(type(v) is int for v in vec):
+                try:
+                    self.vectors[k] = array('q', vec)
+                except OverflowError:
+                    pass
+            elif all(type(v) is float for v in vec):
+                self.vectors[k] = array('d', vec)
+        return self
@@ -0,0 +1,26 @@
+from .clients import RateLimiter, rate_limiter
+
+
+def test_rate_limiter_rpm():
+    limiter = RateLimiter(rpm=60)
+    assert limiter.reserve(0) == 0
+    assert 0.9 < limiter.reserve(0) <= 1.0
+    assert 1.9 < limiter.reserve(0) <= 2.0
+
+
+def test_rate_limiter_tpm():
+    limiter = RateLimiter(tpm=600)  # 10 tokens/s
+    assert limiter.reserve(10) == 0
+    assert 1.9 < limiter.reserve(20) <= 2.0
+    limiter.settle(20, 10)  # used fewer than estimated
+    assert 1.9 < limiter.reserve(10) <= 2.0
+
+
+def test_rate_limiter_options(aipl):
+    assert rate_limiter(aipl, 'gpt-4') is None
+    aipl.options.rpm = 100
+    aipl.options.tpm_gpt_4 = 1000
+    limiter = rate_limiter(aipl, 'gpt-4')
+    assert (limiter.rpm, limiter.tpm) == (100, 1000)
+    assert rate_limiter(aipl, 'gpt-4') is limiter
+    assert rate_limiter(aipl, 'gpt-3.5-turbo').tpm == 0
@@ -1,11 +1,17 @@
 from typing import List
 from collections import defaultdict
+import threading
+import time
+import asyncio
+import os
 import string
 
 import pytest
 
 from .interpreter import defop
-from .table import Table, LazyRow
+from .caching import expensive, dbcache, memoize, cache_key, legacy_cache_key
+from .table import Table, LazyRow, Column
+from .utils import LRUCache
 
 
 @defop('parse-keyval', 0, 0.5)
@@ -76,3 +82,243 @@ def test_out_table_dict(aipl):
     t = r[0].value
     assert set(t.colnames) == set(['digits', 'letters'])
     assert t[0]['digits'] == 1 and t[0]['letters'] == 3
+
+
+def test_table_schema():
+    inner = Table([dict(a=1, b=2)])
+    t = Table([dict(x=inner)])
+    assert t.get_column('x').key == 'x' and inner.get_column('c') is None
+    assert (t.rank, t.shape) == (2, [1, 1])
+
+    inner.add_column(Column('n'))
+    inner.rows[0]['n'] = Table([dict(c=3), dict(c=4)])
+    assert (t.rank, t.shape) == (3, [1, 1, 2])  # t saw inner change
+
+    inner.columns = inner.columns[:-1]
+    assert (t.rank, t.shape) == (2, [1, 1])
+
+    inner.current_col.name = 'bee'
+    assert inner.get_column('bee').key == 'b' and inner.get_column('b') is None
+
+    from . import table
+    renames = table._renames
+    Column('x')
+    inner.current_col.name = 'bee'
+    assert table._renames == renames  # not a rename
+
+    inner = Table()
+    inner.add_column(Column('x'))
+    t = Table([dict(y=inner)])
+    assert (t.rank, t.shape) == (2, [1, 0])
+    inner.rows.append(dict(x=Table([dict(z=1)])))
+    assert (t.rank, t.shape) == (3, [1, 1, 1])
+    inner.rows.append(dict(x=Table([dict(z=2)])))
+    assert t.shape == [1, 2, 1]
+
+    # renames from many threads at once are all seen
+    inner = Table([{f'c{i}': i for i in range(8)}])
+    assert inner.get_column('c0').key == 'c0'
+    def _rename(c):
+        for i in range(1000):
+            c.name = f'{c.key}-{i}'
+            assert inner.get_column(c.name) is c
+    threads = [threading.Thread(target=_rename, args=(c,)) for c in inner.columns]
+    for th in threads: th.start()
+    for th in threads: th.join()
+    assert all(inner.get_column(f'c{i}-999').key == f'c{i}' for i in range(8))
+
+
+_barrier = threading.Barrier(3, timeout=5)
+
+@defop('rendezvous', 0, 0, io_bound=True)
+def op_rendezvous(aipl, v:str) -> str:
+    'Wait until 3 rows are in flight at once; fails if rows are evaluated serially.'
+    _barrier.wait()
+    aipl.cost_usd += 0.25
+    return v.upper()
+
+def test_io_bound_concurrent(aipl):
+    t = aipl.run_test('!split !rendezvous workers=3', 'a b c', 'd e f')
+    assert t[0].value.values == ['A', 'B', 'C']
+    assert t[1].value.values == ['D', 'E', 'F']
+    costs = [r['usd'] for row in t[0].value for r in row['_costs']]
+    assert costs == [0.25, 0.25, 0.25]
+
+    # rows of !sh and !sleep may depend on each other's side effects or pacing
+    assert not aipl.get_op('sh').io_bound and not aipl.get_op('sleep').io_bound
+
+
+_in_flight = []
+
+@defop('async-upper', 0, 0)
+async def op_async_upper(aipl, v:str) -> str:
+    _in_flight.append(v)
+    await asyncio.sleep(0.01)
+    n = len(_in_flight)
+    aipl.cost_usd += 0.5
+    await asyncio.sleep(0.01)
+    _in_flight.remove(v)
+    return f'{v.upper()}{n}'
+
+def test_async_op(aipl):
+    t = aipl.run_test('!split !async-upper workers=2', 'a b c')
+    assert t[0].value.values == ['A2', 'B2', 'C1']
+    assert [r['usd'] for row in t[0].value for r in row['_costs']] == [0.5, 0.5, 0.5]
+
+_ncalls = []
+
+@defop('async-cached', 0, 0)
+@expensive()
+async def op_async_cached(aipl, v:str) -> str:
+    _ncalls.append(v)
+    return v.upper()
+
+def test_async_expensive(cached_aipl):
+    aipl = cached_aipl(debug=True, test=True)
+    t = aipl.run_test('!split !async-cached', 'a b a')
+    assert t[0].value.values == ['A', 'B', 'A']
+    t = aipl.run_test('!split !async-cached', 'a b')
+    assert t[0].value.values == ['A', 'B']
+    assert _ncalls == ['a', 'b']
+
+    aipl.options.dry_run = True
+    t = aipl.run_test('!async-cached', 'c')
+    assert t[0].value.startswith('<op_async_cached(')
+
+
+def test_prefetch(cached_aipl, capsys):
+    aipl = cached_aipl(debug=True, test=True)
+    aipl.run_test('!split !async-cached', 'p q')
+    aipl.cache_mem.clear()
+    selects = []
+    aipl.cache_db.select = lambda tbl, key: selects.append(key) or []
+
+    _ncalls.clear()
+    t = aipl.run_test('!split !async-cached', 'p q r p')
+    assert t[0].value.values == ['P', 'Q', 'R', 'P']
+    assert _ncalls == ['r']
+    assert selects == [cache_key('r'), legacy_cache_key('r')]  # only for the miss
+    assert '!async_cached: 2 cached / 1 to compute' in capsys.readouterr().err
+
+    aipl.cache_mem = LRUCache(max_entries=1)  # prefetched rows are kept for the command even so
+    selects.clear()
+    t = aipl.run_test('!split !async-cached', 'p q r p')
+    assert t[0].value.values == ['P', 'Q', 'R', 'P']
+    assert selects == []
+    assert not aipl.prefetched
+
+
+@defop('getpid', 0, 0, cpu_bound=True)
+def op_getpid(aipl, v:str) -> str:
+    return f'{v}{os.getpid()}'
+
+def test_cpu_bound_procs(aipl):
+    aipl.options.procs = 2
+    t = aipl.run_test('!split !getpid', 'a b c')
+    values = t[0].value.values
+    assert [v[0] for v in values] == ['a', 'b', 'c']
+    assert str(os.getpid()) not in {v[1:] for v in values}
+
+
+@defop('getpid-memo', 0, 0, cpu_bound=True)
+@memoize
+def op_getpid_memo(aipl, v:str) -> str:
+    return f'{v}{os.getpid()}'
+
+def test_cpu_bound_memoize(aipl):
+    aipl.options.procs = 2
+    first = aipl.run_test('!split !getpid-memo', 'a b')[0].value.values
+    assert aipl.run_test('!split !getpid-memo', 'b a')[0].value.values == first[::-1]
+    c = aipl.cache_stats.tables['cached_op_getpid_memo']
+    assert (c.hits, c.misses) == (2, 2)  # looked up in this process, not the workers
+
+
+_counted = []
+
+@defop('count-up', None, 1.5)
+def op_count_up(aipl) -> List[int]:
+    'Yield 0, 1, 2, ... forever.'
+    n = 0
+    while True:
+        yield n
+        n += 1
+
+@defop('counted-str', 0, 0)
+def op_counted_str(aipl, v:int) -> str:
+    _counted.append(v)
+    return str(v)
+
+def test_stream_take(aipl):
+    aipl.options.stream = True
+    _counted.clear()
+    t = aipl.run_test('!count-up !counted-str !take 3')
+    assert t.values == ['0', '1', '2']
+    assert _counted == [0, 1, 2]
+
+def test_stream_finishes(aipl):
+    aipl.options.stream = True
+    _counted.clear()
+    aipl.run_test('!counted-str', 5, 6, 7)
+    assert _counted == [5, 6, 7]
+
+def test_stream_barrier(aipl):
+    aipl.options.stream = True
+    t = aipl.run_test('!split !ravel !uppercase !sort !join', 'c a d', 'b')
+    assert t[0].value == 'A B C D'
+
+
+_overlap = threading.Barrier(2, timeout=5)
+
+@defop('pipe-first', 0, 0)
+def op_pipe_first(aipl, v:str) -> str:
+    if v == '1':
+        _overlap.wait()  # while !pipe-second is working on row 0
+    return v
+
+@defop('pipe-second', 0, 0)
+def op_pipe_second(aipl, v:str) -> str:
+    if v == '0':
+        _overlap.wait()  # while !pipe-first is working on row 1
+    return v+v
+
+def test_pipeline(aipl):
+    aipl.options.pipeline = 2
+    t = aipl.run_test('!pipe-first !pipe-second', '0', '1', '2')
+    assert t.values == ['00', '11', '22']
+
+
+def test_fused(aipl):
+    script = '!split !lowercase>low !uppercase>up !format\n{low}-{up}'
+    cmds = aipl.parse(script)
+    assert aipl._fusable_run(cmds, 1, [aipl.new_input('x')]) == cmds[2:]
+
+    t = aipl.run_test(script, 'A b', 'C')
+    assert t[0].value.values == ['a-A', 'b-B']
+    assert t[1].value[0]['low'] == 'c'
+    assert len(t[1].value[0]['_costs']) == 3
+
+    aipl.fusable = lambda cmd: False
+    unfused = aipl.run_test(script, 'A b', 'C')
+    assert t._asdict() == unfused._asdict()
+    # hidden columns are numbered differently
+    assert [c[0] for c in t[0].value.colnames] == [c[0] for c in unfused[0].value.colnames]
+    assert t[0].value.colnames[-3:-1] == ['low', 'up']
+
+
+_fetched = []
+
+@dbcache
+def _slow_fetch(aipl, v:str) -> str:
+    _fetched.append(v)
+    time.sleep(0.2)
+    return v.upper()
+
+@defop('slow-fetch', 0, 0, io_bound=True)
+def op_slow_fetch(aipl, v:str) -> str:
+    return _slow_fetch(aipl, v)
+
+def test_single_flight(aipl):
+    t = aipl.run_test('!split !slow-fetch workers=4', 'a b a a')
+    assert t[0].value.values == ['A', 'B', 'A', 'A']
+    assert sorted(_fetched) == ['a', 'b']
+    assert aipl.single_flight.deduped == 2
@@ -1,14 +1,395 @@
 from . import Database
 
 
-def test_db():
-    import tempfile
-    with tempfile.NamedTemporaryFile() as f:
-        with Database(f.name) as db:
-            db.insert('people', id=10, name='James Jones')
-            db.insert('people', id=11, name='Maria Garcia')
-            db.insert('people', id=12, name='Michael Smith')
-
-        db = Database(f.name)
-        assert len(db.table('people')) == 3
-        assert db.query('SELECT * FROM people WHERE id=?', 12)[0].name == 'Michael Smith'
+def test_db(tmp_path):
+    dbfn = str(tmp_path/'test.sqlite')
+    with Database(dbfn) as db:
+        db.insert('people', id=10, name='James Jones')
+        db.insert('people', id=11, name='Maria Garcia')
+        db.insert('people', id=12, name='Michael Smith')
+
+    db = Database(dbfn)
+    assert len(db.table('people')) == 3
+    assert db.query('SELECT * FROM people WHERE id=?', 12)[0].name == 'Michael Smith'
+
+
+def test_cache_keys(cache_dbfn, cached_aipl):
+    from .caching import cache_key, dbcache
+
+    assert cache_key('a', x=1, y='2') == cache_key('a', y='2', x=1)
+    assert cache_key('a', x=1) != cache_key('a', x='1')
+
+    calls = []
+    @dbcache
+    def upper(aipl, v:str, **kwargs):
+        calls.append(v)
+        return v.upper()
+
+    with Database(cache_dbfn) as db:  # from before keys were hashed
+        db.insert('cached_upper', key="('old',) {'n': 1}", output='OLD')
+        db.insert('cached_upper', key="('old',) {'n': 1}", output='OLDER')
+
+    aipl = cached_aipl()
+    assert upper(aipl, 'old', n=1) == 'OLDER'
+    assert upper(aipl, 'new', n=1) == 'NEW'
+    assert upper(aipl, 'new', n=1) == 'NEW'
+    assert calls == ['new']
+    assert aipl.cache_db.has_index('cached_upper', 'cached_upper_key')
+    assert len(aipl.cache_db.table('cached_upper')) == 3  # 'old' under legacy and new key
+
+
+def test_cache_mem(cached_aipl):
+    from .caching import dbcache
+    from .interpreter import AIPL
+    from .utils import LRUCache
+
+    lru = LRUCache(max_entries=2, max_bytes=200)
+    lru.put('a', 'x'*10)
+    lru.put('b', 'x'*10)
+    lru.get('a')
+    lru.put('c', 'x'*10)  # evicts least recently used
+    assert lru.get('b') is None and lru.get('a') and lru.get('c')
+    lru.put('d', 'x'*140)
+    assert list(lru.entries) == ['d']
+    assert (lru.hits, lru.misses) == (3, 1)
+
+    @dbcache
+    def double(aipl, v:str):
+        return dict(a=v, b=v+v)
+
+    @dbcache
+    def letters(aipl, v:str):
+        return list(v)
+
+    aipl = cached_aipl()
+    assert double(aipl, 'x') == dict(a='x', b='xx')
+    letters(aipl, 'ab').append('c')
+
+    aipl.cache_db.select = None  # from memory only now
+    assert double(aipl, 'x') == dict(a='x', b='xx')
+    assert aipl.cache_mem.hits == 1
+
+    # results from memory are not shared with callers that change them
+    letters(aipl, 'ab').append('d')
+    assert letters(aipl, 'ab') == ['a', 'b']
+
+    assert AIPL().cache_mem.max_entries == 1000
+
+
+def test_cache_gc(cached_aipl, tmp_path):
+    from .caching import dbcache, cache_gc, cache_backend, cache_key
+
+    calls = []
+    @dbcache(ttl='1h')
+    def fetch(aipl, v:str):
+        calls.append(v)
+        return v*100
+
+    aipl = cached_aipl()
+    for v in 'abcd':
+        fetch(aipl, v)
+
+    db = aipl.cache_db
+    db.con.execute('UPDATE cached_fetch SET _created=_created-7200 WHERE output=?', ('a'*100,))  # expired
+    db.con.execute('UPDATE cached_fetch SET _accessed=_accessed-60 WHERE output=?', ('b'*100,))  # least recently used
+    db.con.commit()
+    aipl.cache_mem.clear()
+
+    assert fetch(aipl, 'a') == 'a'*100
+    assert calls == list('abcda')
+
+    aipl.options.cache_ttl_fetch = 0  # no expiry for this function
+    db.con.execute('UPDATE cached_fetch SET _created=_created-7200 WHERE output=?', ('c'*100,))
+    db.con.commit()
+    stats = cache_gc(aipl, max_bytes=700)  # each entry is about 200 bytes
+    assert (stats.expired, stats.evicted) == (0, 1)
+    assert sorted(r.output[0] for r in db.table('cached_fetch')) == list('acd')
+
+    del aipl.options['cache_ttl_fetch']
+    stats = cache_gc(aipl)
+    assert stats.expired == 1
+
+    # same through the CacheBackend interface
+    aipl = cached_aipl(cache_backend='dbm', cachedbfn=str(tmp_path/'kv.sqlite'))
+    for v in 'abcd':
+        fetch(aipl, v)
+    backend = cache_backend(aipl)
+    for v, age in [('a', 7200), ('b', 60)]:
+        row = backend.get('cached_fetch', cache_key(v))
+        backend.put('cached_fetch', cache_key(v), dict(row, _created=row['_created']-age, _accessed=row['_accessed']-age))
+
+    stats = cache_gc(aipl, max_bytes=2500)  # each row is about 1000 bytes in memory
+    assert (stats.expired, stats.evicted) == (1, 1)
+    assert sorted(row['output'][0] for _, _, row in backend.items()) == list('cd')
+    backend.close()
+
+
+def test_db_batching(tmp_path):
+    dbfn = str(tmp_path/'test.sqlite')
+    db = Database(dbfn, batch_rows=3, batch_secs=60)
+    assert db.query('PRAGMA journal_mode')[0].journal_mode == 'wal'
+
+    db.buffer('nums', n=1)
+    db.buffer('nums', n=2)
+    assert not Database(dbfn).table('nums')  # not yet committed
+    assert len(db.table('nums')) == 2  # but readable here
+
+    db.buffer('nums', n=3)  # batch_rows reached
+    assert len(Database(dbfn).table('nums')) == 3
+
+    db.insert_many('nums', [dict(n=4), dict(n=5)])
+    db.flush()
+    assert [r.n for r in Database(dbfn).table('nums')] == [1, 2, 3, 4, 5]
+
+
+def test_dbinsert(aipl, tmp_path):
+    aipl.output_db = Database(str(tmp_path/'out.sqlite'))
+    aipl.run_test('!split>name !dbinsert people', 'a b c')
+    assert [r.name for r in Database(aipl.output_db.dbfn).table('people')] == ['a', 'b', 'c']
+
+
+def test_cache_lease(cached_aipl):
+    'Runs sharing a cache db (as separate processes would) compute each key once.'
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from .caching import dbcache
+
+    calls = []
+    @dbcache
+    def slow_upper(aipl, v:str):
+        calls.append(v)
+        time.sleep(0.3)
+        return v.upper()
+
+    runs = [cached_aipl() for _ in range(3)]
+    with ThreadPoolExecutor(3) as pool:
+        results = list(pool.map(lambda aipl: [slow_upper(aipl, v) for v in 'ab'], runs))
+
+    assert results == [['A', 'B']]*3
+    assert sorted(calls) == ['a', 'b']
+    for aipl in runs:
+        aipl.flush()  # releases are committed with the results
+    assert not runs[0].cache_db.table('_cache_leases')
+
+
+def test_cache_lease_commits(cached_aipl):
+    'Leases for a batch of misses are taken in one transaction, and released along with the results.'
+    from .caching import expensive
+
+    @expensive(batch=True)
+    def triple(aipl, values:list):
+        return [v*3 for v in values]
+
+    aipl = cached_aipl()
+    triple(aipl, ['z'])  # creates tables
+    aipl.cache_db.insert('unrelated', x=1)
+    statements = []
+    aipl.cache_db.con.set_trace_callback(statements.append)
+    assert triple(aipl, list('abcdefghij')) == [c*3 for c in 'abcdefghij']
+    assert statements.count('COMMIT') == 1  # the leases (and the unrelated row); results and releases are committed in the next batch
+    aipl.flush()
+    assert not aipl.cache_db.table('_cache_leases')
+    assert len(aipl.cache_db.table('cached_triple')) == 11
+
+
+def test_cache_migrate_shared(cache_dbfn, cached_aipl):
+    'Connections (as separate processes would have) that each saw a cache table before migrating it.'
+    from .caching import _migrate, CACHE_META, cache_backend
+
+    db1, db2 = Database(cache_dbfn), Database(cache_dbfn)
+    db1.insert('cached_f', key='k', output='v')  # from before CACHE_META
+    db1.flush()
+    assert 'output' in db1.get_table_info('cached_f') and 'output' in db2.get_table_info('cached_f')
+    _migrate(db1, 'cached_f')
+    _migrate(db2, 'cached_f')  # its table info is out of date; must not add the columns again
+    assert set(CACHE_META) <= set(Database(cache_dbfn).get_table_info('cached_f'))
+
+    cache_backend(cached_aipl()).put('cached_g', 'k', dict(output='v', _created=0))
+    assert set(CACHE_META) <= set(Database(cache_dbfn).get_table_info('cached_g'))  # created with all of them
+
+
+def test_cache_blobs(cached_aipl, tmp_path):
+    import os
+    from .caching import dbcache, cache_gc, blob_dir, cache_backend, cache_key
+
+    @dbcache
+    def fetch_bytes(aipl, url:str):
+        return b'%PDF' + b'x'*100
+
+    @dbcache
+    def fetch_page(aipl, url:str):
+        return dict(text='y'*100, title=url)
+
+    for kind in ['sqlite', 'dbm']:
+        aipl = cached_aipl(cache_blob_bytes=50, cache_codec='none', cache_backend=kind, cachedbfn=str(tmp_path/f'{kind}.sqlite'))
+        fetch_bytes(aipl, 'a')
+        fetch_bytes(aipl, 'b')  # same contents
+        fetch_page(aipl, 'c')
+        aipl.cache_mem.clear()
+
+        assert fetch_bytes(aipl, 'b') == b'%PDF' + b'x'*100
+        assert fetch_page(aipl, 'c') == dict(text='y'*100, title='c')
+        backend = cache_backend(aipl)
+        assert len(backend.get('cached_fetch_bytes', cache_key('a'))['output']) == 64  # just the hash
+        assert sum(len(fns) for _, _, fns in os.walk(blob_dir(aipl))) == 2
+
+        backend.delete('cached_fetch_page', [cache_key('c')])
+        assert cache_gc(aipl).blobs_deleted == 1
+        assert fetch_bytes(aipl, 'a') == b'%PDF' + b'x'*100
+        backend.close()
+
+
+def test_cache_compress(cached_aipl):
+    import json
+    from .caching import dbcache, cache_key, write_codec
+
+    @dbcache
+    def answer(aipl, q:str):
+        return q*1000
+
+    aipl = cached_aipl(cache_codec='none')
+    answer(aipl, 'old')  # stored before compression
+
+    aipl = cached_aipl(cache_compress_bytes=100)
+    answer(aipl, 'new')
+    aipl.cache_mem.clear()
+    assert answer(aipl, 'old') == 'old'*1000
+    assert answer(aipl, 'new') == 'new'*1000
+
+    old, new = aipl.cache_db.table('cached_answer')
+    assert old._codec is None and old.output == 'old'*1000
+    assert new._codec == '{"output": ["zlib", "str"]}' and len(new.output) < 100
+
+    aipl = cached_aipl(cache_compress_bytes=100, cache_codec='zstd')
+    assert answer(aipl, 'zst') == 'zst'*1000  # with zlib if zstandard is not installed
+    codec, _ = json.loads(aipl.cache_db.select('cached_answer', key=cache_key('zst'))[0]._codec)['output']
+    assert codec == write_codec(aipl)
+
+
+def test_cache_backends(cached_aipl, tmp_path):
+    import glob
+    import pytest
+    from . import AIPLException
+    import json
+    import pickle
+    from .caching import dbcache, cache_backend, cache_key, CacheBackend, KVBackend
+
+    calls = []
+    @dbcache
+    def length(aipl, v:str):
+        calls.append(v)
+        return dict(n=len(v), data=v.encode()*2000)
+
+    for kind in ['sqlite', 'dbm']:
+        calls.clear()
+        dbfn = str(tmp_path/f'{kind}.sqlite')
+        for _ in range(2):  # second run reads what the first stored
+            aipl = cached_aipl(cache_backend=kind, cachedbfn=dbfn)
+            assert length(aipl, 'abc') == dict(n=3, data=b'abc'*2000)
+            assert length(aipl, 'de')['n'] == 2
+            aipl.flush()
+            cache_backend(aipl).close()
+        assert calls == ['abc', 'de']
+
+        aipl.cache_db = Database(dbfn)
+        backend = cache_backend(aipl)
+        assert backend.name == kind
+        assert backend.stats()['entries'] == 2
+        assert set(backend.get_many('cached_length', [cache_key('de'), 'nope'])) == {cache_key('de')}
+
+        backend.delete('cached_length', [cache_key('de')])
+        assert backend.get('cached_length', cache_key('de')) is None
+        if kind == 'dbm':  # stored as JSON; anything else (like pickles from an older version) is a miss
+            k = backend._k('cached_length', cache_key('abc'))
+            assert json.loads(backend.dbm[k])['n'] == 3
+            backend.dbm[k] = pickle.dumps(dict(n=3))
+            assert backend.get('cached_length', cache_key('abc')) is None
+        backend.close()
+
+    kvdir = tmp_path/'kv'
+    kvdir.mkdir()
+    try:
+        import lmdb
+        backend = KVBackend(str(kvdir/'cache.sqlite'))
+    except ModuleNotFoundError:  # refused, not silently dbm
+        with pytest.raises(AIPLException, match='needs the lmdb package'):
+            cached_aipl(cache_backend='lmdb', cachedbfn=str(kvdir/'cache.sqlite'))
+        backend = KVBackend(str(kvdir/'cache.sqlite'), use_lmdb=False)
+    backend.close()
+    assert all(fn.startswith(backend.path) for fn in glob.glob(str(kvdir/'*')))
+    assert backend.path.endswith('.' + backend.name)
+
+    class _Partial(CacheBackend):
+        def get_many(self, tbl, keys):
+            return {}
+
+    with pytest.raises(TypeError):
+        _Partial()
+
+
+def test_cache_stats(cached_aipl):
+    from .caching import dbcache
+
+    @dbcache
+    def priced(aipl, v:str):
+        aipl.cost_usd += 0.25
+        return v*10
+
+    aipl = cached_aipl()
+    priced(aipl, 'a')
+    aipl.cache_mem.clear()
+    priced(aipl, 'a')
+    priced(aipl, 'a')
+
+    c = aipl.cache_stats.tables['cached_priced']
+    assert (c.hits, c.misses) == (2, 1)
+    assert c.saved_usd == 0.5
+    assert c.bytes_read > 10 and c.bytes_written > 10
+    assert aipl.cache_stats.summary().splitlines()[0].startswith('cache: 2 hits / 1 misses (67%)')
+
+
+def test_memoize(cached_aipl):
+    import json
+    import threading
+    from .caching import memoize, content_key, _cache_get, MISSING
+    from .interpreter import AIPL
+
+    calls = []
+
+    @memoize
+    def parse(aipl, v:str, sep=' '):
+        calls.append(v)
+        yield v.split(sep)
+        yield threading.Lock()  # can't be pickled
+
+    @memoize
+    def words(aipl, v:str):
+        calls.append(v)
+        return v.split()
+
+    big = 'word '*1000
+    aipl = cached_aipl()
+    r = words(aipl, big)
+    r.append('changed')
+    assert words(aipl, 'word '*1000) == ['word']*1000  # a copy, by contents
+    assert len(parse(aipl, 'a b')) == 2
+    assert parse(aipl, 'a b')[0] == ['a', 'b']
+    assert parse(aipl, 'a,b', sep=',')[0] == ['a', 'b']
+    assert calls == [big, 'a b', 'a,b']
+
+    aipl = cached_aipl()  # persisted as JSON, except results that aren't JSON
+    words(aipl, big)
+    parse(aipl, 'a b')
+    assert calls == [big, 'a b', 'a,b', 'a b']
+    assert json.loads(_cache_get(aipl, 'cached_words', content_key(big))) == ['word']*1000
+    assert _cache_get(aipl, 'cached_parse', content_key('a b')) is MISSING
+
+    aipl = cached_aipl(memoize='mem')
+    words(aipl, big)
+    words(aipl, big)
+    assert calls[4:] == [big]
+
+    aipl = AIPL(memoize='off')
+    words(aipl, 'x')
+    words(aipl, 'x')
+    assert calls[5:] == ['x', 'x']
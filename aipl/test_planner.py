@@ -0,0 +1,73 @@
+from .interpreter import defop
+from .caching import expensive
+from . import planner
+
+
+_calls = []
+
+@defop('costly-upper', 0, 0, pure=True)
+@expensive()
+def op_costly_upper(aipl, v:str) -> str:
+    _calls.append(v)
+    return v.upper()
+
+
+def _opnames(aipl, script:str):
+    return [c.opname for c in planner.plan(aipl.parse(script))]
+
+
+def test_plan_take(aipl):
+    assert _opnames(aipl, '!costly-upper !take 2') == ['take', 'costly_upper']
+
+    _calls.clear()
+    aipl.options.plan = True
+    t = aipl.run_test('!costly-upper !take 2', 'a', 'b', 'c')
+    assert t.values == ['A', 'B']
+    assert _calls == ['a', 'b']
+
+
+def test_plan_filter(aipl):
+    script = '''
+!format>keep
+{_}
+!costly-upper>up
+!format
+{keep}
+!filter
+'''
+    assert _opnames(aipl, script) == ['format', 'format', 'filter', 'costly_upper']
+
+    _calls.clear()
+    aipl.options.plan = True
+    t = aipl.run_test(script, 'a', '', 'b')
+    assert t.values == ['A', 'B']
+    assert _calls == ['a', 'b']
+
+
+def test_plan_unsafe(aipl):
+    # !match reads the output of !costly-upper
+    assert _opnames(aipl, '!costly-upper !match A !filter') == ['costly_upper', 'match', 'filter']
+    # the whole output of !costly-upper is saved as a global
+    assert _opnames(aipl, '!costly-upper>>up !take 2') == ['costly_upper', 'take']
+    # nothing costly to skip
+    assert _opnames(aipl, '!replace a b !take 2') == ['replace', 'take']
+
+
+@defop('slow-lower', 0, 0, io_bound=True)
+def op_slow_lower(aipl, v:str) -> str:
+    return v.lower()
+
+
+def test_explain(aipl):
+    cmds = aipl.parse('!costly-upper>up !take 2 !replace a b !replace b c !slow-lower')
+    planned = planner.plan(cmds)
+    assert [(c.opname, notes) for c, notes in planner.annotate(cmds, planned, aipl.fusable)] == [
+        ('take', ['moved ahead of !costly_upper']),
+        ('costly_upper', []),
+        ('replace', ['fused']),
+        ('replace', ['fused']),
+        ('slow_lower', ['concurrent']),
+    ]
+    lines = planner.explain(cmds, planned, aipl.fusable).splitlines()
+    assert lines[0] == 'plan:' and len(lines) == len(planned)+1
+    assert lines[1].endswith('!take 2  # moved ahead of !costly_upper')
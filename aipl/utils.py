@@ -1,5 +1,7 @@
 from typing import Mapping, List
-from collections import ChainMap
+from collections import ChainMap, OrderedDict
+from concurrent.futures import Future
+import threading
 import sys
 
 
@@ -42,6 +44,121 @@ class AttrDict(dict):
         self[k] = v
 
 
+class SingleFlight:
+    'Calls in progress by key, so that identical calls made meanwhile can wait for the result of the first instead of repeating it.'
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> Future
+        self.deduped = 0  # number of calls that waited for another
+
+    def claim(self, key) -> tuple:
+        'Return (future, True) if the caller should make the call and then finish(key, ...); or (future of the call in progress, False).'
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                self.deduped += 1
+                return future, False
+            future = self.calls[key] = Future()
+            return future, True
+
+    def finish(self, key, result=None, exception:BaseException=None):
+        'Give *result* (or raise *exception*) to the calls waiting on *key*.'
+        with self.lock:
+            future = self.calls.pop(key)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
+def sizeof(v) -> int:
+    'Return rough number of bytes taken by *v*.'
+    if isinstance(v, (str, bytes)):
+        return len(v) + 50
+    if isinstance(v, Mapping):
+        return sum(sizeof(k) + sizeof(x) for k, x in v.items()) + 50
+    if isinstance(v, (list, tuple)):
+        return sum(sizeof(x) for x in v) + 50
+    return 30
+
+
+class LRUCache:
+    'Mapping of the most recently used entries, at most *max_entries* of them taking at most *max_bytes* in total (0 for no limit).'
+    def __init__(self, max_entries:int=0, max_bytes:int=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, nbytes); least recently used first
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value):
+        n = sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            if self.max_bytes and n > self.max_bytes:
+                return  # would evict everything else
+            self.entries[key] = (value, n)
+            self.nbytes += n
+            while (self.max_entries and len(self.entries) > self.max_entries) or (self.max_bytes and self.nbytes > self.max_bytes):
+                self.nbytes -= self.entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class CacheStats:
+    'Counters of @dbcache lookups and writes, by cache table.'
+    fields = ('hits', 'misses', 'bytes_read', 'bytes_written', 'lookup_secs', 'saved_usd', 'saved_secs')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = {}  # tblname -> AttrDict of fields
+
+    def add(self, tbl:str, **kwargs):
+        with self.lock:
+            counts = self.tables.setdefault(tbl, AttrDict((k, 0) for k in self.fields))
+            for k, v in kwargs.items():
+                counts[k] += v
+
+    def total(self) -> AttrDict:
+        'Return sums of all counters.'
+        with self.lock:
+            return AttrDict((k, sum(counts[k] for counts in self.tables.values())) for k in self.fields)
+
+    def __bool__(self):
+        return bool(self.tables)
+
+    def summary(self) -> str:
+        'Return lines describing counts overall and for each table.'
+        def _line(name, c):
+            nlookups = c.hits + c.misses
+            pct = f' ({c.hits/nlookups:.0%})' if nlookups else ''
+            return (f'{name}: {c.hits} hits / {c.misses} misses{pct}, {c.bytes_read/2**20:.1f}MB read, {c.bytes_written/2**20:.1f}MB written, '
+                    f'{c.lookup_secs*1000/(nlookups or 1):.1f}ms per lookup; saved ${c.saved_usd:.02f} and {c.saved_secs:.0f}s')
+
+        lines = [_line('cache', self.total())]
+        with self.lock:
+            lines.extend(_line('  '+tbl, c) for tbl, c in sorted(self.tables.items()))
+        return '\n'.join(lines)
+
+
 def strify(x, maxlen=0):
     if isinstance(x, (list, tuple)):
         if not x:
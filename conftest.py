@@ -6,3 +6,16 @@ from aipl import AIPL
 def aipl():
     r = AIPL(debug=True, test=True)
     return r
+
+@pytest.fixture()
+def cache_dbfn(tmp_path):
+    'Filename for a cache db, removed after the test.'
+    return str(tmp_path/'cache.sqlite')
+
+@pytest.fixture()
+def cached_aipl(cache_dbfn):
+    'Return function to make AIPL(**options) with its own connection to the same cache db, as separate runs would have.'
+    def _new(**options):
+        options.setdefault('cachedbfn', cache_dbfn)
+        return AIPL(**options)
+    return _new